@@ -24,9 +24,23 @@ from os.path import exists
 import glob
 import time
 import math
-import array
+import codecs
+import io
+import struct
 import inspect
+import json
+import marshal
+import mmap
+import shutil
+import socket
+import select
+import sqlite3
+import numbers
 import timeit
+import cProfile
+import ctypes
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import inro.modeller
 import traceback as _traceback
 import inro.modeller as _m
@@ -35,28 +49,69 @@ from threading import Thread
 import threading
 import time
 from contextlib import contextmanager
+from collections import OrderedDict
 import six
+try:
+    import numpy as _np
+except ImportError:
+    _np = None
 
+# Polls a tool's percent_completed and reports it to XTMF.  Only changes larger
+# than MinimumChange are sent, and the polling interval adapts to how quickly
+# the progress is moving, backing off while it sits still.
 class ProgressTimer(Thread):
+    MinimumInterval = 0.05
+    MaximumInterval = 1.0
+    MinimumChange = 0.001
+
     def __init__(self, delegateFunction, XtmfBridge):
-        self._stopped = False
+        self._stopEvent = threading.Event()
         self.delegateFunction = delegateFunction
         self.bridge = XtmfBridge
+        self.lastReported = None
         Thread.__init__(self)
+        self.daemon = True
         self.run = self._run
+
+    @staticmethod
+    def ComputeProgress(progress):
+        """Convert what percent_completed returned into a fraction from 0 to 1, or None if it can not be understood.
+        A tool can return a number, a (start, end, current) tuple, or a list of these tuples where each one
+        breaks down the current step of the one before it, for example [(0, stages, stage), (0, 100, percent)]."""
+        if isinstance(progress, numbers.Real):
+            return min(max(float(progress), 0.0), 1.0)
+        levels = [progress] if len(progress) == 3 and isinstance(progress[0], numbers.Real) else progress
+        ret = 0.0
+        scale = 1.0
+        for start, end, current in levels:
+            span = float(end - start)
+            if span <= 0:
+                if scale == 1.0:
+                    return None
+                break
+            ret += scale * min(max((current - start) / span, 0.0), 1.0)
+            scale /= span
+        return min(ret, 1.0)
     
     def _run(self):
-        try:
-            while not self._stopped:
-                progressTuple = self.delegateFunction()
-                self.bridge.ReportProgress(float(progressTuple[2] - progressTuple[0]) / float(progressTuple[1] - progressTuple[0]))
-                time.sleep(0.01667)
-        except:
-            # silently fail if we are unable to understand what the progress tuple is doing.
-            pass
+        interval = self.MinimumInterval
+        while not self._stopEvent.wait(interval):
+            try:
+                progress = self.ComputeProgress(self.delegateFunction())
+            except:
+                # skip samples we are unable to understand, the tool may not have started reporting yet
+                progress = None
+            if progress is not None and (self.lastReported is None or abs(progress - self.lastReported) >= self.MinimumChange):
+                self.bridge.ReportProgress(progress)
+                self.lastReported = progress
+                interval = max(self.MinimumInterval, interval * 0.5)
+            else:
+                interval = min(self.MaximumInterval, interval * 2.0)
     
     def stop(self):
-        self._stopped = True
+        """Stop reporting, returning once the last report has been sent"""
+        self._stopEvent.set()
+        self.join()
 
 # A Stream that does nothing
 class NullStream:
@@ -81,6 +136,1717 @@ class RedirectToXTMFConsole:
     def flush(self):
         pass
 
+# The tags that prefix each value sent with SignalStartModuleTypedParameters
+class TypeTag:
+    Int64 = 0
+    Float64 = 1
+    Bool = 2
+    String = 3
+    Bytes = 4
+    # The following are only used for return values
+    Null = 5
+    List = 6
+    Dictionary = 7
+    Array = 8
+
+def _ViewSize(view):
+    """The number of bytes in the view, Python 2's memoryview has no nbytes"""
+    size = view.itemsize
+    for dimension in view.shape or ():
+        size *= dimension
+    return size
+
+def _IsCContiguous(view):
+    contiguous = getattr(view, "c_contiguous", None)
+    if contiguous is not None:
+        return contiguous
+    # Python 2's memoryview can only tell us its strides
+    expected = view.itemsize
+    for dimension, stride in reversed(list(zip(view.shape or (), view.strides or ()))):
+        if dimension > 1 and stride != expected:
+            return False
+        expected *= dimension
+    return True
+
+def EncodeTypedValue(value):
+    """Generate the typed encoding of a return value, piece by piece so large results never need to be in memory twice"""
+    if value is None:
+        yield bytes(bytearray([TypeTag.Null]))
+    elif isinstance(value, bool):
+        yield bytes(bytearray([TypeTag.Bool, 1 if value else 0]))
+    elif isinstance(value, six.integer_types) and -0x8000000000000000 <= value <= 0x7FFFFFFFFFFFFFFF:
+        yield bytes(bytearray([TypeTag.Int64])) + XTMFInputBuffer._Int64.pack(value)
+    elif isinstance(value, float):
+        yield bytes(bytearray([TypeTag.Float64])) + XTMFInputBuffer._Double.pack(value)
+    elif isinstance(value, six.text_type):
+        encoded = value.encode("utf-8")
+        yield bytes(bytearray([TypeTag.String])) + EncodeLEB(len(encoded))
+        yield encoded
+    elif isinstance(value, (bytes, bytearray)):
+        yield bytes(bytearray([TypeTag.Bytes])) + EncodeLEB(len(value))
+        yield value
+    elif isinstance(value, dict):
+        yield bytes(bytearray([TypeTag.Dictionary])) + EncodeLEB(len(value))
+        for key in value:
+            for piece in EncodeTypedValue(key):
+                yield piece
+            for piece in EncodeTypedValue(value[key]):
+                yield piece
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        yield bytes(bytearray([TypeTag.List])) + EncodeLEB(len(value))
+        for item in value:
+            for piece in EncodeTypedValue(item):
+                yield piece
+    elif _np is not None and isinstance(value, _np.generic):
+        for piece in EncodeTypedValue(value.item()):
+            yield piece
+    else:
+        try:
+            if _np is not None and isinstance(value, _np.ndarray):
+                value = _np.ascontiguousarray(value)
+            view = memoryview(value)
+        except TypeError:
+            view = None
+        if view is None or not _IsCContiguous(view):
+            for piece in EncodeTypedValue(str(value)):
+                yield piece
+            return
+        # Raw numeric data, described by its struct format and shape then sent straight from its buffer
+        header = bytearray([TypeTag.Array])
+        elementFormat = view.format.encode("utf-8")
+        header += EncodeLEB(len(elementFormat)) + elementFormat
+        header += EncodeLEB(view.itemsize) + EncodeLEB(view.ndim)
+        for dimension in view.shape:
+            header += EncodeLEB(dimension)
+        size = _ViewSize(view)
+        header += EncodeLEB(size)
+        yield bytes(header)
+        if size == 0:
+            yield b""
+        elif hasattr(view, "cast"):
+            yield view.cast("B")
+        elif _np is not None and isinstance(value, _np.ndarray):
+            yield memoryview(value.reshape(-1).view(_np.uint8))
+        else:
+            yield view.tobytes()
+
+# The connection to XTMF, both directions of the protocol go through a transport.
+# send takes any buffer and recv_into fills a memoryview, returning the number of
+# bytes read or 0 once XTMF has closed its end.  write and readinto are the same
+# thing under the names the reader and writer use for file streams.
+class XTMFTransport:
+    def send(self, data):
+        raise NotImplementedError()
+
+    def recv_into(self, view):
+        raise NotImplementedError()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, data):
+        self.send(data)
+        return len(data)
+
+    def readinto(self, view):
+        return self.recv_into(view)
+
+# The original transport, we write to the named pipe XTMF creates and read from our standard input.
+class NamedPipeTransport(XTMFTransport):
+    def __init__(self, pipeName):
+        self.output = open('\\\\.\\pipe\\' + pipeName, 'wb', 0)
+        # Use the raw stream so a read returns whatever is already in the pipe
+        self.input = os.fdopen(0, "rb", 0)
+
+    def send(self, data):
+        # An unbuffered write may take only part of the data
+        view = memoryview(data)
+        while len(view) > 0:
+            written = self.output.write(view)
+            if written is None:
+                # Python 2's files write everything and return nothing
+                break
+            view = view[written:]
+
+    def recv_into(self, view):
+        return self.input.readinto(view)
+
+    def close(self):
+        self.output.close()
+
+# A Unix domain socket or TCP connection to an address XTMF is listening on.
+class SocketTransport(XTMFTransport):
+    def __init__(self, family, address):
+        self.socket = socket.socket(family, socket.SOCK_STREAM)
+        self.socket.connect(address)
+        if family != getattr(socket, "AF_UNIX", None):
+            # Messages are already batched by the writer, do not hold them back any longer
+            self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send(self, data):
+        self.socket.sendall(data)
+
+    def recv_into(self, view):
+        return self.socket.recv_into(view)
+
+    def close(self):
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.socket.close()
+
+# A single producer, single consumer ring of bytes in a memory mapped file.  The
+# header holds the capacity, the total number of bytes written and read so far,
+# if either side is waiting and if the writer has closed the ring.  Each side only
+# changes its own fields.  A side that has nothing to do spins for a moment and
+# then waits on a FIFO, the doorbell, which the other side only writes to when it
+# sees the waiting flag, so steady traffic never makes a system call.  A wait
+# never lasts longer than WaitTimeout in case a ring of the doorbell is missed.
+class SharedMemoryRing:
+    Magic = b"XTMR"
+    HeaderSize = 64
+    _Capacity = struct.Struct("<I")
+    _Position = struct.Struct("<Q")
+    _Flag = struct.Struct("<I")
+    _WrittenOffset = 8
+    _ReadOffset = 16
+    _ReaderWaitingOffset = 24
+    _WriterWaitingOffset = 28
+    _ClosedOffset = 32
+
+    def __init__(self, path, capacity=4194304, spinCount=2000, waitTimeout=0.05):
+        if not exists(path):
+            with open(path, "wb") as ringFile:
+                ringFile.write(self.Magic + self._Capacity.pack(capacity))
+                ringFile.truncate(self.HeaderSize + capacity)
+        for bell in (path + ".data", path + ".space"):
+            if not exists(bell):
+                os.mkfifo(bell)
+        self.file = open(path, "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        self.view = memoryview(self.map)
+        if self.map[0:4] != self.Magic:
+            raise Exception("The file " + path + " is not a shared memory ring!")
+        self.capacity = self._Capacity.unpack_from(self.map, 4)[0]
+        # Opening for both reading and writing means neither side blocks waiting for the other to open it
+        self.dataBell = os.open(path + ".data", os.O_RDWR)
+        self.spaceBell = os.open(path + ".space", os.O_RDWR)
+        self.spinCount = spinCount
+        self.waitTimeout = waitTimeout
+
+    def _Get(self, field, offset):
+        return field.unpack_from(self.map, offset)[0]
+
+    def _Wait(self, bell, waitingOffset, ready):
+        """Wait until ready() is true, spinning first and then sleeping on the doorbell"""
+        for i in range(self.spinCount):
+            if ready():
+                return
+        self._Flag.pack_into(self.map, waitingOffset, 1)
+        try:
+            while not ready():
+                if select.select([bell], [], [], self.waitTimeout)[0]:
+                    os.read(bell, 4096)
+        finally:
+            self._Flag.pack_into(self.map, waitingOffset, 0)
+
+    def _Ring(self, bell, waitingOffset):
+        if self._Get(self._Flag, waitingOffset):
+            os.write(bell, b"\x00")
+
+    def send(self, data):
+        view = memoryview(data)
+        total = len(view)
+        offset = 0
+        capacity = self.capacity
+        written = self._Get(self._Position, self._WrittenOffset)
+        while offset < total:
+            free = capacity - (written - self._Get(self._Position, self._ReadOffset))
+            if free == 0:
+                self._Wait(self.spaceBell, self._WriterWaitingOffset,
+                           lambda: self._Get(self._Position, self._ReadOffset) != written - capacity)
+                continue
+            length = min(free, total - offset)
+            start = self.HeaderSize + written % capacity
+            first = min(length, self.HeaderSize + capacity - start)
+            self.view[start:start + first] = view[offset:offset + first]
+            if length > first:
+                self.view[self.HeaderSize:self.HeaderSize + length - first] = view[offset + first:offset + length]
+            offset += length
+            written += length
+            # Publish the data only after it has been copied in
+            self._Position.pack_into(self.map, self._WrittenOffset, written)
+            self._Ring(self.dataBell, self._ReaderWaitingOffset)
+
+    def recv_into(self, view):
+        capacity = self.capacity
+        read = self._Get(self._Position, self._ReadOffset)
+        available = lambda: self._Get(self._Position, self._WrittenOffset) - read
+        if available() == 0:
+            self._Wait(self.dataBell, self._ReaderWaitingOffset, lambda: available() > 0 or self._Get(self._Flag, self._ClosedOffset))
+            if available() == 0:
+                return 0
+        length = min(available(), len(view))
+        start = self.HeaderSize + read % capacity
+        first = min(length, self.HeaderSize + capacity - start)
+        view[0:first] = self.view[start:start + first]
+        if length > first:
+            view[first:length] = self.view[self.HeaderSize:self.HeaderSize + length - first]
+        self._Position.pack_into(self.map, self._ReadOffset, read + length)
+        self._Ring(self.spaceBell, self._WriterWaitingOffset)
+        return length
+
+    def close(self):
+        self._Flag.pack_into(self.map, self._ClosedOffset, 1)
+        os.write(self.dataBell, b"\x00")
+        self.view.release()
+        self.map.close()
+        self.file.close()
+        os.close(self.dataBell)
+        os.close(self.spaceBell)
+
+# Talks to XTMF through two shared memory rings, <path>.toxtmf and <path>.fromxtmf.
+# The bells it uses are FIFOs so this is only available where os.mkfifo is.
+class SharedMemoryTransport(XTMFTransport):
+    def __init__(self, path):
+        self.output = SharedMemoryRing(path + ".toxtmf")
+        self.input = SharedMemoryRing(path + ".fromxtmf")
+
+    def send(self, data):
+        self.output.send(data)
+
+    def recv_into(self, view):
+        return self.input.recv_into(view)
+
+    def close(self):
+        self.output.close()
+        self.input.close()
+
+def OpenTransport(address):
+    """Connect to XTMF, the address is scheme:location or just the name of a named pipe.
+    The schemes are pipe:name, unix:path, tcp:host:port and shm:path"""
+    scheme, separator, location = address.partition(":")
+    if separator and scheme == "unix":
+        return SocketTransport(socket.AF_UNIX, location)
+    if separator and scheme == "tcp":
+        host, separator, port = location.rpartition(":")
+        return SocketTransport(socket.AF_INET, (host or "127.0.0.1", int(port)))
+    if separator and scheme == "shm":
+        return SharedMemoryTransport(location)
+    if separator and scheme == "pipe":
+        return NamedPipeTransport(location)
+    return NamedPipeTransport(address)
+
+# Writes a session with XTMF to a trace file so that it can be studied, or fed
+# back into a bridge with stub tools, without Emme.  The file starts with Magic
+# and is followed by records, each a kind byte and the LEB microseconds since
+# the previous record.  Inbound and Outbound records hold the bytes exactly as
+# they went through the transport, as an LEB length and the data.  Call records
+# are written and stamped when the call finishes, after everything it sent, and
+# hold the LEB duration in microseconds, a byte of CallSucceeded and ToolFound
+# flags, the namespace and the number, names and types of the tool's parameters,
+# all strings being an LEB length followed by UTF-8.
+class SessionRecorder:
+    Magic = b"XTMFTRC1"
+    Inbound = 0
+    Outbound = 1
+    Call = 2
+    CallSucceeded = 1
+    ToolFound = 2
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(self.Magic)
+        self._lock = threading.Lock()
+        self._last = timeit.default_timer()
+
+    def _Header(self, kind, when):
+        # Must be called while holding the lock
+        delta = max(0, int((when - self._last) * 1000000))
+        self._last = max(self._last, when)
+        return bytearray([kind]) + EncodeLEB(delta)
+
+    @staticmethod
+    def _String(text):
+        encoded = six.text_type(text).encode("utf-8")
+        return EncodeLEB(len(encoded)) + encoded
+
+    def RecordData(self, kind, data):
+        when = timeit.default_timer()
+        with self._lock:
+            self.file.write(self._Header(kind, when) + EncodeLEB(len(data)))
+            self.file.write(data)
+
+    def RecordCall(self, call, start, duration, success):
+        signature = call.Signature
+        names = signature.ParameterNames if signature is not None else []
+        types = signature.ParameterTypes if signature is not None else []
+        with self._lock:
+            # Stamped with the end, the start is before the records of what was sent during the call
+            record = self._Header(self.Call, start + duration)
+            record += EncodeLEB(int(duration * 1000000))
+            record.append((self.CallSucceeded if success else 0) | (self.ToolFound if signature is not None else 0))
+            record += self._String(call.Namespace)
+            record += EncodeLEB(len(names))
+            for name, typeName in zip(names, types):
+                record += self._String(name) + self._String(typeName)
+            self.file.write(record)
+
+    def Close(self):
+        with self._lock:
+            self.file.close()
+
+def ReadSessionRecords(path):
+    """Generate the records of a trace made by SessionRecorder as tuples of the kind, the seconds since the session started
+    and then either the data, or the duration, success, if the tool was found, namespace, parameter names and types of a call.
+    For a call the seconds are from when it started, the records are in the order they were written"""
+    with open(path, "rb") as traceFile:
+        if traceFile.read(len(SessionRecorder.Magic)) != SessionRecorder.Magic:
+            raise Exception("The file " + path + " is not a bridge session trace!")
+        reader = XTMFInputBuffer(traceFile)
+        reader.SetEncoding("utf-8")
+        elapsed = 0
+        while True:
+            try:
+                kind = reader.ReadByte()
+            except EOFError:
+                return
+            elapsed += reader.ReadLEB()
+            if kind == SessionRecorder.Call:
+                duration = reader.ReadLEB() / 1000000.0
+                flags = reader.ReadByte()
+                namespace = reader.ReadString()
+                names = []
+                types = []
+                for i in range(reader.ReadLEB()):
+                    names.append(reader.ReadString())
+                    types.append(reader.ReadString())
+                yield (kind, max(0.0, elapsed / 1000000.0 - duration), duration, (flags & SessionRecorder.CallSucceeded) != 0,
+                       (flags & SessionRecorder.ToolFound) != 0, namespace, names, types)
+            else:
+                yield (kind, elapsed / 1000000.0, bytes(reader.ReadBytes(reader.ReadLEB())))
+
+# Passes everything through to another transport, recording it on the way.
+class RecordingTransport(XTMFTransport):
+    def __init__(self, transport, recorder):
+        self.transport = transport
+        self.recorder = recorder
+
+    def send(self, data):
+        self.recorder.RecordData(SessionRecorder.Outbound, data)
+        self.transport.send(data)
+
+    def recv_into(self, view):
+        read = self.transport.recv_into(view)
+        if read:
+            self.recorder.RecordData(SessionRecorder.Inbound, view[0:read])
+        return read
+
+    def flush(self):
+        self.transport.flush()
+
+    def close(self):
+        self.transport.close()
+
+# Reads the binary protocol coming from XTMF.  Instead of asking the stream for
+# every byte we pull whatever is available into a reusable buffer and decode
+# the LEB lengths, integers and strings straight out of it.
+class XTMFInputBuffer:
+    _Int32 = struct.Struct("<i")
+    _FrameHeader = struct.Struct("<iii")
+    _Int64 = struct.Struct("<q")
+    _Double = struct.Struct("<d")
+
+    def __init__(self, stream, capacity=65536):
+        self.stream = stream
+        self._decode = codecs.utf_16_le_decode
+        self._buffer = bytearray(capacity)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+
+    def _Fill(self, required):
+        """Make sure that at least 'required' bytes are available in the buffer"""
+        available = self._end - self._start
+        if available >= required:
+            return
+        if required > len(self._buffer):
+            # Grow the buffer, it has exported a view so we need a new one and leave the old one to the views still using it
+            capacity = len(self._buffer)
+            while capacity < required:
+                capacity <<= 1
+            newBuffer = bytearray(capacity)
+            newBuffer[0:available] = self._view[self._start:self._end]
+            self._buffer = newBuffer
+            self._view = memoryview(newBuffer)
+        elif self._start > 0:
+            # Compact the remaining bytes to the front of the buffer
+            self._buffer[0:available] = self._view[self._start:self._end]
+        self._start = 0
+        self._end = available
+        while self._end < required:
+            read = self.stream.readinto(self._view[self._end:])
+            if not read:
+                raise EOFError("The stream from XTMF has been closed.")
+            self._end += read
+
+    def ReadFrame(self):
+        """Read a message from the framed protocol, returning its signal, request id and payload"""
+        self._Fill(12)
+        signal, requestId, length = self._FrameHeader.unpack_from(self._buffer, self._start)
+        self._start += 12
+        return signal, requestId, bytes(self.ReadBytes(length))
+
+    def ReadBytes(self, length):
+        """Returns a view of the next 'length' bytes, only valid until the next read"""
+        self._Fill(length)
+        start = self._start
+        self._start += length
+        return self._view[start:self._start]
+
+    def ReadLEB(self):
+        ret = 0
+        bitIndex = 0
+        while True:
+            if self._start >= self._end:
+                self._Fill(1)
+            current = self._buffer[self._start]
+            self._start += 1
+            ret |= (current & 0x7F) << bitIndex
+            if current < 128:
+                return ret
+            bitIndex += 7
+
+    def ReadInt(self):
+        self._Fill(4)
+        ret = self._Int32.unpack_from(self._buffer, self._start)[0]
+        self._start += 4
+        return ret
+
+    def SetEncoding(self, encoding):
+        self._decode = codecs.getdecoder(encoding)
+
+    def ReadString(self):
+        # The length is the number of bytes of encoded characters
+        length = self.ReadLEB()
+        return self._decode(self.ReadBytes(length))[0]
+
+    def ReadByte(self):
+        if self._start >= self._end:
+            self._Fill(1)
+        self._start += 1
+        return self._buffer[self._start - 1]
+
+    def ReadInt64(self):
+        self._Fill(8)
+        ret = self._Int64.unpack_from(self._buffer, self._start)[0]
+        self._start += 8
+        return ret
+
+    def ReadDouble(self):
+        self._Fill(8)
+        ret = self._Double.unpack_from(self._buffer, self._start)[0]
+        self._start += 8
+        return ret
+
+    def ReadUTF8String(self):
+        length = self.ReadLEB()
+        return codecs.utf_8_decode(self.ReadBytes(length))[0]
+
+    def ReadTypedValue(self):
+        """Read a value that is prefixed by its TypeTag"""
+        tag = self.ReadByte()
+        if tag == TypeTag.Int64:
+            return self.ReadInt64()
+        elif tag == TypeTag.Float64:
+            return self.ReadDouble()
+        elif tag == TypeTag.Bool:
+            return self.ReadByte() != 0
+        elif tag == TypeTag.String:
+            return self.ReadUTF8String()
+        elif tag == TypeTag.Bytes:
+            return bytes(self.ReadBytes(self.ReadLEB()))
+        raise Exception("Unknown type tag " + str(tag) + " for a typed parameter!")
+
+def EncodeLEB(value):
+    """Encode a non-negative integer as the 7-bit length prefix used by .Net's BinaryWriter"""
+    lengthArray = bytearray()
+    while value >= 128:
+        lengthArray.append((value & 0x7F) | 0x80)
+        value >>= 7
+    lengthArray.append(value)
+    return bytes(lengthArray)
+
+# Writes the messages going to XTMF from its own thread so the executing tool
+# never blocks on the pipe.  Consecutive prints are merged into a single
+# message, only the latest pending progress report is kept, and everything
+# else is written in the order it was queued.  Everything is encoded by the
+# thread that queues it, so only a failure to write means XTMF has gone away.
+class XTMFOutputWriter(Thread):
+    _Print = 0
+    _Progress = 1
+    _Frame = 2
+    _Float = struct.Struct("<f")
+
+    def __init__(self, bridge, stream, maxPrintCharacters=16384, flushInterval=0.05, maxPendingBytes=8388608):
+        Thread.__init__(self)
+        self.daemon = True
+        self.bridge = bridge
+        self.stream = stream
+        self.maxPrintCharacters = maxPrintCharacters
+        self.flushInterval = flushInterval
+        self.maxPendingBytes = maxPendingBytes
+        self._condition = threading.Condition()
+        self._pending = []
+        self._pendingBytes = 0
+        self._pendingProgress = None
+        self._pendingPrintCharacters = 0
+        self._firstPendingTime = None
+        self._urgent = False
+        self._closed = False
+        self._queued = 0
+        self._written = 0
+        self._failed = False
+
+    def _Queue(self, entry, urgent):
+        # Must be called while holding the condition
+        if not self._pending:
+            self._firstPendingTime = time.time()
+        self._pending.append(entry)
+        self._queued += 1
+        if urgent:
+            self._urgent = True
+        self._condition.notify()
+
+    def Print(self, text, requestId=0):
+        encoded = self.bridge.EncodeText(text)
+        with self._condition:
+            if self._pending and self._pending[-1][0] == self._Print and self._pending[-1][2] == requestId:
+                self._pending[-1][1].append(encoded)
+            else:
+                self._Queue([self._Print, [encoded], requestId], False)
+            self._pendingPrintCharacters += len(text)
+            if self._pendingPrintCharacters >= self.maxPrintCharacters:
+                self._urgent = True
+                self._condition.notify()
+
+    def Progress(self, progress, requestId=0):
+        encoded = self._Float.pack(float(progress))
+        with self._condition:
+            if self._pendingProgress is not None and self._pendingProgress[2] == requestId:
+                self._pendingProgress[1] = encoded
+            else:
+                self._pendingProgress = [self._Progress, encoded, requestId]
+                self._Queue(self._pendingProgress, False)
+
+    def Send(self, frame):
+        """Queue an already encoded message, the queue is flushed right away"""
+        with self._condition:
+            # Hold back the sender if XTMF is not keeping up so large results do not pile up in memory
+            while self._pendingBytes > self.maxPendingBytes and not self._failed and self.is_alive():
+                self._condition.wait(0.1)
+            self._pendingBytes += len(frame)
+            self._Queue([self._Frame, frame, None], True)
+
+    def Flush(self):
+        """Block until everything queued so far has been written"""
+        with self._condition:
+            target = self._queued
+            self._urgent = True
+            self._condition.notify()
+            while self._written < target and not self._failed and self.is_alive():
+                self._condition.wait(0.1)
+
+    def Close(self):
+        self.Flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self.join()
+
+    def _Encode(self, entries):
+        buffer = bytearray()
+        bridge = self.bridge
+        for kind, value, requestId in entries:
+            if kind == self._Frame:
+                buffer += value
+            elif kind == self._Print:
+                text = b"".join(value)
+                buffer += bridge.EncodeMessage(bridge.SignalSendPrintMessage, EncodeLEB(len(text)) + text, requestId)
+            else:
+                buffer += bridge.EncodeMessage(bridge.SignalProgressReport, value, requestId)
+        return buffer
+
+    def run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._pending:
+                        if self._urgent or self._closed:
+                            break
+                        remaining = self.flushInterval - (time.time() - self._firstPendingTime)
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    elif self._closed:
+                        return
+                    else:
+                        self._condition.wait()
+                entries = self._pending
+                self._pending = []
+                self._pendingProgress = None
+                self._pendingPrintCharacters = 0
+                self._pendingBytes = 0
+                self._urgent = False
+            data = self._Encode(entries)
+            try:
+                if not self._failed:
+                    self.stream.write(data)
+                    self.stream.flush()
+            except Exception:
+                # XTMF has gone away, the reading side will notice and shut us down
+                self._failed = True
+            with self._condition:
+                self._written += len(entries)
+                self._condition.notify_all()
+
+def _ConvertToBool(value):
+    lowered = value.lower()
+    if lowered in ['true','t','tru','tr']:
+        return True
+    elif lowered in ['false','f','fals','fal']:
+        return False
+    raise ValueError(value)
+
+"""How to convert the string sent by XTMF for each parameter type, and how to describe the type in errors"""
+ParameterConverters = {
+    "int": (int, "an integer"),
+    "float": (float, "a float"),
+    "string": (None, "a string"),
+    "bool": (_ConvertToBool, "a bool"),
+}
+
+# The parameter names, types and converters of a tool class.  None of this
+# changes between calls so it is resolved once and kept until the script that
+# defines the tool is modified.
+class ToolSignature:
+    def __init__(self, toolClass, parameterNames, parameterTypes):
+        self.ToolClass = toolClass
+        self.ParameterNames = parameterNames
+        self.ParameterTypes = parameterTypes
+        self.Converters = [ParameterConverters[t][0] for t in parameterTypes]
+        self.ScriptPath = ToolSignature.GetScriptPath(toolClass)
+        self.ScriptTime = ToolSignature.GetScriptTime(self.ScriptPath)
+
+    @staticmethod
+    def GetScriptPath(toolClass):
+        module = sys.modules.get(toolClass.__module__)
+        return getattr(module, "__file__", None)
+
+    @staticmethod
+    def GetScriptTime(scriptPath):
+        if scriptPath is None:
+            return None
+        try:
+            return os.path.getmtime(scriptPath)
+        except OSError:
+            return None
+
+    def IsCurrent(self):
+        return ToolSignature.GetScriptTime(self.ScriptPath) == self.ScriptTime
+
+    def Assign(self, tool, parameterList):
+        """Assign the already typed parameters to the tool's attributes"""
+        for name, value in zip(self.ParameterNames, parameterList):
+            setattr(tool, name, value)
+
+    def Call(self, tool, parameterList):
+        return tool.__call__(*parameterList)
+
+    def Invoke(self, tool, parameterList, timing=None):
+        """Assign the already typed parameters to the tool's attributes and then run it"""
+        self.Assign(tool, parameterList)
+        if timing is not None:
+            timing.Mark("assign")
+        return self.Call(tool, parameterList)
+
+# Checks that every tool in the loaded toolboxes can be run, collecting all of
+# the problems instead of stopping at the first.  Each element of a toolbox is
+# looked up once and namespaces are built from their parent's, the scripts of
+# unconsolidated tools are then checked on a pool of threads since they are often
+# on network shares.  What was found in a toolbox is kept along with the time its
+# file was changed, while that does not change the toolbox is not walked again
+# and only the scripts are checked.
+class ToolboxValidator:
+    def __init__(self, maxThreads=16):
+        self.maxThreads = maxThreads
+        self._results = {}
+
+    @staticmethod
+    def _FileTime(path):
+        try:
+            return os.path.getmtime(path)
+        except (OSError, TypeError):
+            return None
+
+    def Validate(self, toolboxes):
+        """Returns the list of problems found in the toolboxes, it is empty if all of the tools can be run"""
+        errors = []
+        for toolbox in toolboxes:
+            toolboxPath = getattr(toolbox, "path", None)
+            toolboxTime = self._FileTime(toolboxPath)
+            cached = self._results.get(toolboxPath) if toolboxTime is not None else None
+            if cached is not None and cached[0] == toolboxTime:
+                walkErrors, scripts = cached[1], cached[2]
+            else:
+                walkErrors, scripts = self._Walk(toolbox)
+                if toolboxTime is not None:
+                    self._results[toolboxPath] = (toolboxTime, walkErrors, scripts)
+            errors.extend(walkErrors)
+            scriptTimes = self._ScriptTimes([script for namespace, script in scripts])
+            for (namespace, script), scriptTime in zip(scripts, scriptTimes):
+                if scriptTime is None:
+                    errors.append("The unconsolidated tool \"" + namespace + "\" calls a file that does not exist \"" + script + "\"!")
+        return errors
+
+    def _ScriptTimes(self, scripts):
+        if len(scripts) <= 1:
+            return [self._FileTime(script) for script in scripts]
+        pool = ThreadPool(min(self.maxThreads, len(scripts)))
+        try:
+            return pool.map(self._FileTime, scripts)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _Walk(self, toolbox):
+        """Find the problems in the toolbox itself and the (namespace, script) of each unconsolidated tool"""
+        errors = []
+        scripts = []
+        elements = {}
+        namespaces = {}
+        def get_element(index):
+            if index not in elements:
+                elements[index] = toolbox.element(index)
+            return elements[index]
+        def get_namespace(index):
+            # Walk up until we find an ancestor whose namespace we already know
+            chain = []
+            while index is not None and index not in namespaces:
+                chain.append(index)
+                element = get_element(index)
+                if element is None:
+                    raise Exception("its parent element " + str(index) + " does not exist in the toolbox")
+                index = element["parent_id"]
+            prefix = namespaces.get(index)
+            for child in reversed(chain):
+                part = get_element(child)["attributes"]["namespace"]
+                prefix = part if prefix is None else prefix + "." + part
+                namespaces[child] = prefix
+            return prefix
+        toExplore = [toolbox.root]
+        while toExplore:
+            index = toExplore.pop()
+            # A broken element is reported along with the others instead of stopping the check
+            try:
+                element = get_element(index)
+                if element is None:
+                    errors.append("The given element " + str(index) + " does not exist in the toolbox!")
+                    continue
+                if "attributes" not in element:
+                    errors.append("The element does not have any attributes " + str(index))
+                    continue
+                attributes = element["attributes"]
+                if "children" in attributes:
+                    children = attributes["children"]
+                    # Reversed so that the tools are reported in the order of the toolbox
+                    toExplore.extend(reversed([int(x) for x in children[1:len(children) - 1].split(",") if x.strip()]))
+                elif "code" in attributes and not attributes["code"]:
+                    # Directories have no code attribute and consolidated tools carry their code
+                    script = attributes["script"]
+                    if not script:
+                        errors.append("There is no file path for the unconsolidated tool " + get_namespace(index) + " defined!")
+                    else:
+                        scripts.append((get_namespace(index), script))
+            except Exception as inst:
+                errors.append("Unable to check the element " + str(index) + " of the toolbox: " + str(inst))
+        return errors, scripts
+
+# An index of the tool namespaces that Modeller knows about.  Lookups are made
+# against a set, and a prefix trie of the namespace parts is kept to describe
+# where a missing namespace diverges from the loaded tools.  The index is
+# rebuilt when a namespace is not found, and invalidated when XTMF checks the
+# toolboxes or a tool it lists can no longer be created since it may have been
+# removed from a toolbox.  The set and the trie are replaced together as one
+# snapshot, so a lookup on the reader thread can not see them invalidated part
+# way through.
+class ToolNamespaceIndex:
+    def __init__(self, modeller):
+        self.modeller = modeller
+        self._index = None
+
+    def Refresh(self):
+        """Rebuild the index, returning the namespaces and the trie"""
+        namespaces = set(self.modeller.tool_namespaces())
+        trie = {}
+        for namespace in namespaces:
+            node = trie
+            for part in namespace.split("."):
+                node = node.setdefault(part, {})
+        index = (namespaces, trie)
+        self._index = index
+        return index
+
+    def Invalidate(self):
+        self._index = None
+
+    def Contains(self, namespace):
+        index = self._index
+        if index is not None and namespace in index[0]:
+            return True
+        # We might not have seen a toolbox that was loaded since we last looked
+        return namespace in self.Refresh()[0]
+
+    def DescribeMissing(self, namespace):
+        """Describe the deepest part of the namespace that exists and what it contains"""
+        index = self._index
+        if index is None:
+            index = self.Refresh()
+        node = index[1]
+        found = []
+        for part in namespace.split("."):
+            if part not in node:
+                break
+            found.append(part)
+            node = node[part]
+        options = sorted(node.keys())[:10]
+        if not found:
+            return "No loaded toolbox has a namespace starting with '" + namespace.split(".")[0] + "'."
+        return "The namespace '" + str.join(".", found) + "' exists and contains: " + str.join(", ", options)
+
+# A request to run a tool, read completely from XTMF before anything is executed.
+# Binary and typed parameter calls have their names and values, otherwise the
+# parameters are still in a single string.
+class ModuleCall:
+    def __init__(self, namespace, parameterNames=None, parameterList=None, parameterString=None, typed=False):
+        self.Namespace = namespace
+        self.ParameterNames = parameterNames
+        self.ParameterList = parameterList
+        self.ParameterString = parameterString
+        self.Typed = typed
+        # The signature of the tool once it has been found
+        self.Signature = None
+
+    def DescribeParameters(self):
+        """Build the parameter string for the logbook, this is only needed when something goes wrong"""
+        if self.ParameterString is None and self.ParameterNames is not None:
+            self.ParameterString = str.join(',', ['{%s:%s}' %(self.ParameterNames[p], self.ParameterList[p]) for p in range(0, len(self.ParameterList))])
+        return self.ParameterString
+
+# A block of memory shared with XTMF to move matrix data without going through
+# the disk.  The channel name is either the path of a file to map, or the name
+# of a shared memory segment.  The data starts with a small header that gives
+# the element type and the dimensions, followed by the values in row order.
+class MatrixChannel:
+    Header = struct.Struct("<4sHHIII12x")
+    Magic = b"XTMM"
+    Version = 1
+    TypeCodes = {"float32": 1, "float64": 2, "int32": 3, "int64": 4, "int16": 5, "int8": 6,
+                 "uint8": 7, "uint16": 8, "uint32": 9, "uint64": 10}
+    TypeNames = dict((code, name) for name, code in TypeCodes.items())
+
+    def __init__(self, name, size=0):
+        self.Name = name
+        self.Size = size
+        self._file = None
+        self._map = self._Open(size)
+        if size == 0:
+            # We are reading an existing channel, find out how large it is
+            size = self.Header.size + self.ReadShapeAndType()[2]
+            if len(self._map) < size:
+                self._map.close()
+                self._map = self._Open(size)
+            self.Size = size
+
+    def _Open(self, size):
+        path = self.Name
+        if not (os.sep in path or "/" in path):
+            if os.name == "nt":
+                return mmap.mmap(-1, max(size, self.Header.size), tagname=self.Name)
+            path = os.path.join("/dev/shm", self.Name)
+        if self._file is None:
+            # Only an export creates the channel, an import needs it to already exist
+            self._file = open(path, "w+b" if size > 0 and not exists(path) else "r+b")
+        if size > 0 and os.path.getsize(path) < size:
+            self._file.truncate(size)
+        return mmap.mmap(self._file.fileno(), size)
+
+    def ReadShapeAndType(self):
+        magic, version, typeCode, ndim, rows, columns = self.Header.unpack_from(self._map, 0)
+        if magic != self.Magic or version != self.Version:
+            raise Exception("The matrix channel '" + self.Name + "' does not contain a matrix in a format we understand!")
+        if typeCode not in self.TypeNames:
+            raise Exception("The matrix channel '" + self.Name + "' uses an unknown data type " + str(typeCode) + "!")
+        shape = (rows, columns) if ndim == 2 else (rows,)
+        dtype = _np.dtype(self.TypeNames[typeCode])
+        return shape, dtype, rows * (columns if ndim == 2 else 1) * dtype.itemsize
+
+    def GetData(self):
+        """Get a view of the matrix stored in the channel, this does not copy the data"""
+        shape, dtype, size = self.ReadShapeAndType()
+        count = size // dtype.itemsize
+        return _np.frombuffer(self._map, dtype, count, self.Header.size).reshape(shape)
+
+    def SetData(self, data):
+        dtype = data.dtype.name
+        if dtype not in self.TypeCodes:
+            # Converting it could lose precision, XTMF would not know that it did
+            raise Exception("The matrix uses the data type " + dtype + " which can not be sent through a matrix channel!")
+        rows = data.shape[0]
+        columns = data.shape[1] if data.ndim == 2 else 1
+        self.Header.pack_into(self._map, 0, self.Magic, self.Version, self.TypeCodes[dtype], data.ndim, rows, columns)
+        destination = _np.frombuffer(self._map, data.dtype, data.size, self.Header.size).reshape(data.shape)
+        destination[...] = data
+        del destination
+        return self.Header.size + data.nbytes
+
+    def Close(self):
+        self._map.close()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+# The time spent in each phase of handling one tool call
+class CallTiming:
+    def __init__(self, recorder):
+        self.recorder = recorder
+        self.phases = []
+        self.last = timeit.default_timer()
+
+    def Mark(self, phase):
+        """Record the time since the previous mark as the given phase"""
+        now = timeit.default_timer()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def Finish(self, namespace):
+        self.recorder.Record(namespace, self.phases)
+
+# Stands in for CallTiming when performance recording is turned off
+class NullCallTiming:
+    def Mark(self, phase):
+        pass
+
+    def Finish(self, namespace):
+        pass
+
+# Timing statistics for one phase of one tool, keeping the most recent samples for percentiles
+class PhaseStatistics:
+    MaxSamples = 1024
+
+    def __init__(self):
+        self.Count = 0
+        self.Total = 0.0
+        self.Maximum = 0.0
+        self.Samples = []
+
+    def Add(self, seconds):
+        if self.Count < self.MaxSamples:
+            self.Samples.append(seconds)
+        else:
+            self.Samples[self.Count % self.MaxSamples] = seconds
+        self.Count += 1
+        self.Total += seconds
+        self.Maximum = max(self.Maximum, seconds)
+
+    def Summary(self):
+        ordered = sorted(self.Samples)
+        def percentile(p):
+            return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+        return {"count": self.Count, "total": self.Total, "mean": self.Total / self.Count, "max": self.Maximum,
+                "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)}
+
+# Collects how long each phase of a tool call takes, per tool namespace, so the
+# bridge's own overhead can be told apart from the time spent inside Emme.
+# "decode" is the time to parse the call once its signal has arrived and "queue"
+# the time to encode the reply and hand it to the writer thread, which sends the
+# replies of many calls together so the socket time is not part of any one call.
+class PerformanceRecorder:
+    Phases = ["decode", "namespace", "create", "types", "convert", "assign", "run", "queue"]
+
+    def __init__(self, enabled):
+        self.Enabled = enabled
+        self._statistics = {}
+        self._lock = threading.Lock()
+        self._nullTiming = NullCallTiming()
+
+    def StartCall(self):
+        if self.Enabled:
+            return CallTiming(self)
+        return self._nullTiming
+
+    def Record(self, namespace, phases):
+        total = 0.0
+        with self._lock:
+            toolStatistics = self._statistics.setdefault(namespace, {})
+            for phase, seconds in phases:
+                toolStatistics.setdefault(phase, PhaseStatistics()).Add(seconds)
+                total += seconds
+            toolStatistics.setdefault("total", PhaseStatistics()).Add(total)
+
+    def Report(self):
+        with self._lock:
+            return dict((namespace, dict((phase, statistics.Summary()) for phase, statistics in toolStatistics.items()))
+                        for namespace, toolStatistics in self._statistics.items())
+
+    def DumpJsonLines(self, path):
+        with open(path, "a") as output:
+            for namespace, phases in self.Report().items():
+                for phase, summary in phases.items():
+                    summary["namespace"] = namespace
+                    summary["phase"] = phase
+                    output.write(json.dumps(summary) + "\n")
+
+# Samples the stack of a thread at a fixed interval and counts each distinct
+# stack, producing the collapsed stack text used to build flame graphs.
+class StackSampler(Thread):
+    def __init__(self, threadId, skipFrames=0, interval=0.005):
+        Thread.__init__(self)
+        self.daemon = True
+        self.threadId = threadId
+        self.skipFrames = skipFrames
+        self.interval = interval
+        self.stacks = {}
+        self._stopEvent = threading.Event()
+
+    def run(self):
+        while not self._stopEvent.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.reverse()
+            # leave out the frames of the bridge that are outside of the tool
+            stack = stack[self.skipFrames:]
+            if stack:
+                key = str.join(";", stack)
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def stop(self):
+        self._stopEvent.set()
+        self.join()
+
+    def Collapsed(self):
+        return str.join("", ["%s %d\n" % (stack, count) for stack, count in self.stacks.items()]).encode("utf-8")
+
+# Profiles the next tool calls XTMF asked for, optionally only for some
+# namespaces, keeping each result until XTMF collects them.  "pstats" results
+# are the marshalled cProfile statistics, the same as a pstats dump file, and
+# "collapsed" results are sampled stacks in the collapsed flame graph format.
+class ToolProfiler:
+    Formats = ["pstats", "collapsed"]
+
+    def __init__(self):
+        self.Remaining = 0
+        self.Namespaces = None
+        self.Format = "pstats"
+        self.Results = []
+
+    def Arm(self, count, namespaces, profileFormat):
+        if profileFormat not in self.Formats:
+            raise Exception("Unknown profile format '" + profileFormat + "', expected one of " + str.join(", ", self.Formats) + "!")
+        self.Remaining = count
+        self.Namespaces = set(namespaces) if namespaces else None
+        self.Format = profileFormat
+
+    def ShouldProfile(self, namespace):
+        if self.Remaining <= 0:
+            return False
+        return self.Namespaces is None or namespace in self.Namespaces
+
+    def Profile(self, namespace, function, *args):
+        self.Remaining -= 1
+        if self.Format == "pstats":
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+                profile.create_stats()
+                self.Results.append((namespace, self.Format, marshal.dumps(profile.stats)))
+        depth = 0
+        frame = sys._getframe()
+        while frame is not None:
+            depth += 1
+            frame = frame.f_back
+        sampler = StackSampler(threading.current_thread().ident, depth)
+        sampler.start()
+        try:
+            return function(*args)
+        finally:
+            sampler.stop()
+            self.Results.append((namespace, self.Format, sampler.Collapsed()))
+
+    def TakeResults(self):
+        results = self.Results
+        self.Results = []
+        return results
+
+# Remembers the return values of the tools that XTMF has marked as safe to
+# reuse.  A result is only replayed when the namespace, the typed parameters
+# and the data version all match.  The data version includes a generation that
+# moves whenever a tool runs that XTMF has not marked as read only for the data
+# cache, or the bridge changes the emmebank for XTMF, the modification time of
+# the emmebank, and the modification times of any parameters that name existing
+# files.
+class ToolResultCache:
+    def __init__(self):
+        self.Capacity = 0
+        self.Namespaces = set()
+        self.Generation = 0
+        self.Hits = 0
+        self.Misses = 0
+        self._entries = OrderedDict()
+
+    def Configure(self, capacity, namespaces):
+        self.Capacity = max(0, capacity)
+        self.Namespaces = set(namespaces)
+        self.Invalidate()
+
+    def IsCacheable(self, namespace):
+        return self.Capacity > 0 and namespace in self.Namespaces
+
+    def MakeKey(self, namespace, parameterList, emmebankPath):
+        fileVersions = []
+        for value in parameterList:
+            if isinstance(value, six.string_types) and value and exists(value):
+                fileVersions.append((value, os.path.getmtime(value)))
+        emmebankVersion = os.path.getmtime(emmebankPath) if emmebankPath and exists(emmebankPath) else None
+        return (namespace, tuple(parameterList), self.Generation, emmebankVersion, tuple(fileVersions))
+
+    def Get(self, key):
+        """Returns if the key was found, and the cached return value"""
+        if key in self._entries:
+            # reinsert to make it the most recently used
+            returnValue = self._entries.pop(key)
+            self._entries[key] = returnValue
+            self.Hits += 1
+            return True, returnValue
+        self.Misses += 1
+        return False, None
+
+    def Put(self, key, returnValue):
+        self._entries.pop(key, None)
+        self._entries[key] = returnValue
+        while len(self._entries) > self.Capacity:
+            self._entries.popitem(last=False)
+
+    def Invalidate(self, namespaces=None):
+        if not namespaces:
+            self._entries.clear()
+            return
+        for key in [key for key in self._entries if key[0] in namespaces]:
+            del self._entries[key]
+
+    def DataChanged(self):
+        """Another tool is about to run or the emmebank was changed, it may change anything our results depend on"""
+        self.Generation += 1
+
+# Keeps expensive reads of Emme scenarios, such as networks, between tool calls.
+# Tools reach it through tool.XTMFBridge and must treat what it returns as read
+# only.  Each scenario has a change counter that moves when a tool publishes a
+# network or changes attributes through the scenario, and every entry for all
+# scenarios is dropped after a tool runs that XTMF has not marked as read only.
+# The estimated size of the entries is kept under a budget, evicting the least
+# recently used first.
+class EmmeDataCache:
+    BytesPerNetworkElement = 1024
+    MutatingScenarioMethods = ["publish_network", "set_attribute_values", "create_extra_attribute", "delete_extra_attribute",
+                               "create_network_field", "delete_network_field", "set_network_field_values"]
+
+    def __init__(self, budget=2147483648):
+        self.Budget = budget
+        self.ReadOnlyNamespaces = set()
+        self._entries = OrderedDict()
+        self._changeCounts = {}
+        self._size = 0
+        self._hookedTypes = set()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def ScenarioKey(scenario):
+        return getattr(scenario, "number", scenario)
+
+    def _HookScenarioType(self, scenarioType):
+        """Wrap the methods that change a scenario so we see the change"""
+        if scenarioType in self._hookedTypes:
+            return
+        self._hookedTypes.add(scenarioType)
+        cache = self
+        def wrap(original):
+            def changesScenario(scenario, *args, **kwargs):
+                try:
+                    return original(scenario, *args, **kwargs)
+                finally:
+                    cache.ScenarioChanged(scenario)
+            return changesScenario
+        for name in self.MutatingScenarioMethods:
+            original = getattr(scenarioType, name, None)
+            if original is not None:
+                setattr(scenarioType, name, wrap(original))
+
+    def Get(self, scenario, key, factory, size=None):
+        """Get the value stored for the scenario under key, calling factory() to create it if needed"""
+        self._HookScenarioType(type(scenario))
+        entryKey = (self.ScenarioKey(scenario), key)
+        with self._lock:
+            changeCount = self._changeCounts.get(entryKey[0], 0)
+            entry = self._entries.get(entryKey)
+            if entry is not None and entry[0] == changeCount:
+                # reinsert to make it the most recently used
+                self._entries[entryKey] = self._entries.pop(entryKey)
+                return entry[1]
+        value = factory()
+        if size is None:
+            size = sys.getsizeof(value)
+        with self._lock:
+            self._Remove(entryKey)
+            if size <= self.Budget:
+                self._entries[entryKey] = (changeCount, value, size)
+                self._size += size
+                while self._size > self.Budget:
+                    self._Remove(next(iter(self._entries)))
+        return value
+
+    def GetNetwork(self, scenario):
+        return self.Get(scenario, "network", scenario.get_network, self.EstimateNetworkSize(scenario))
+
+    def EstimateNetworkSize(self, scenario):
+        try:
+            return sum(scenario.element_totals.values()) * self.BytesPerNetworkElement
+        except Exception:
+            return 0
+
+    def _Remove(self, entryKey):
+        entry = self._entries.pop(entryKey, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def ScenarioChanged(self, scenario):
+        scenarioKey = self.ScenarioKey(scenario)
+        with self._lock:
+            self._changeCounts[scenarioKey] = self._changeCounts.get(scenarioKey, 0) + 1
+            for entryKey in [entryKey for entryKey in self._entries if entryKey[0] == scenarioKey]:
+                self._Remove(entryKey)
+
+    def Clear(self):
+        with self._lock:
+            for scenarioKey in self._changeCounts:
+                self._changeCounts[scenarioKey] += 1
+            self._entries.clear()
+            self._size = 0
+
+    def ToolFinished(self, namespace):
+        if namespace not in self.ReadOnlyNamespaces:
+            self.Clear()
+
+# Raised inside a tool that did not stop in time after it was cancelled.  It is
+# not an Exception so that a tool's own error handling will not swallow it.
+class ToolCancelledError(BaseException):
+    pass
+
+# Tools check IsCancelled on tool.XTMFBridge.CancellationToken in their loops
+# and return early once it is set.
+class CancellationToken:
+    def __init__(self):
+        self._event = threading.Event()
+        self.Reason = None
+
+    @property
+    def IsCancelled(self):
+        return self._event.is_set()
+
+    def Cancel(self, reason):
+        if not self._event.is_set():
+            self.Reason = reason
+            self._event.set()
+
+    def ThrowIfCancelled(self):
+        if self._event.is_set():
+            raise ToolCancelledError(self.Reason)
+
+# The cancellation state of a single tool call.  A watchdog thread is only
+# started when the call has a timeout or gets cancelled; once the token is set
+# the tool has a grace period to return on its own before ToolCancelledError is
+# raised in the thread that is running it.  That can only happen while the tool
+# is running Python code, a long call into Emme finishes first.
+class ToolCancellation:
+    def __init__(self, threadId, timeout, gracePeriod):
+        self.Token = CancellationToken()
+        self.threadId = threadId
+        self.timeout = timeout
+        self.gracePeriod = gracePeriod
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._done = threading.Event()
+        self._finished = False
+        self._injected = False
+        self._watchdog = None
+        if timeout > 0:
+            self._StartWatchdog()
+
+    def _StartWatchdog(self):
+        if self._watchdog is None:
+            self._watchdog = Thread(target=self._Watch)
+            self._watchdog.daemon = True
+            self._watchdog.start()
+
+    def Cancel(self, reason):
+        with self._lock:
+            if self._finished:
+                return False
+            self.Token.Cancel(reason)
+            self._StartWatchdog()
+        self._wake.set()
+        return True
+
+    def _Watch(self):
+        if not self._wake.wait(self.timeout if self.timeout > 0 else None):
+            self.Cancel("it ran for longer than its timeout of %g seconds" % self.timeout)
+        self._done.wait(self.gracePeriod)
+        with self._lock:
+            if self._finished:
+                return
+            self._injected = True
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.threadId), ctypes.py_object(ToolCancelledError))
+
+    def Finish(self):
+        with self._lock:
+            self._finished = True
+            if self._injected:
+                # The exception may still be pending, it must not go off in the bridge
+                ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self.threadId), None)
+        self._done.set()
+        self._wake.set()
+
+# The stream a pool worker's output writer uses, each write is sent to the main
+# bridge tagged with the request that is currently executing.
+class PoolWorkerStream:
+    def __init__(self, connection, sendLock):
+        self.connection = connection
+        self.sendLock = sendLock
+        self.RequestId = -1
+
+    def write(self, data):
+        with self.sendLock:
+            self.connection.send(("frames", self.RequestId, bytes(data)))
+        return len(data)
+
+    def flush(self):
+        pass
+
+class PoolWorker:
+    def __init__(self, index, process, connection):
+        self.index = index
+        self.process = process
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.outstanding = 0
+        self.pending = set()
+        self.alive = True
+        self.relay = None
+
+# Runs tool calls on a pool of Emme applications, each in its own process with
+# its own copy of the project, so that independent calls can execute in parallel.
+# Calls with the same non-negative affinity always go to the same worker, any
+# other call goes to the worker with the fewest outstanding calls.  Everything a
+# worker sends for a call is relayed to XTMF tagged with the call's request id.
+# If a worker's process exits, the calls it still had fail and no more calls
+# are sent to it.
+class ModellerWorkerPool:
+    def __init__(self, bridge, projectFiles, userInitials, databankName):
+        self.bridge = bridge
+        self.workers = []
+        for projectFile in projectFiles:
+            connection, workerConnection = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=RunPoolWorker, args=(projectFile, userInitials, databankName, workerConnection))
+            process.daemon = True
+            process.start()
+            # Only the worker may hold its end, otherwise we would never see it exit
+            workerConnection.close()
+            self.workers.append(PoolWorker(len(self.workers), process, connection))
+        # The workers start Emme at the same time, wait for all of them before accepting calls
+        errors = []
+        for index, worker in enumerate(self.workers):
+            try:
+                status, message = worker.connection.recv()
+            except EOFError:
+                status, message = "failed", "the process exited"
+            if status != "ready":
+                errors.append("Worker %d (%s) failed to start: %s" % (index, projectFiles[index], message))
+        if errors:
+            self.Close()
+            raise Exception(str.join("\r\n", errors))
+        for worker in self.workers:
+            worker.relay = Thread(target=self._Relay, args=(worker,))
+            worker.relay.daemon = True
+            worker.relay.start()
+
+    def _Relay(self, worker):
+        bridge = self.bridge
+        while True:
+            try:
+                message = worker.connection.recv()
+            except (EOFError, IOError, OSError):
+                self._WorkerExited(worker)
+                return
+            if message[0] == "frames":
+                data = message[2]
+                bridge.SendFrame(bridge.SignalPoolOutput, bridge.EncodeInt(message[1]) + EncodeLEB(len(data)) + data, message[1])
+            elif message[0] == "done":
+                with worker.lock:
+                    worker.outstanding -= 1
+                    worker.pending.discard(message[1])
+                bridge.DataChanged()
+                bridge.SendFrame(bridge.SignalPoolCallComplete, bridge.EncodeInt(message[1]) + (b"\x01" if message[2] else b"\x00"), message[1])
+
+    def _WorkerExited(self, worker):
+        with worker.lock:
+            worker.alive = False
+            lost = sorted(worker.pending)
+            worker.pending.clear()
+            worker.outstanding = 0
+        if not lost:
+            return
+        worker.process.join(1)
+        problem = "The Emme process of worker %d exited with code %s while running the call!" % (worker.index, worker.process.exitcode)
+        _m.logbook_write(problem)
+        for requestId in lost:
+            self.FailCall(requestId, problem)
+
+    def FailCall(self, requestId, problem):
+        """Tell XTMF that the call failed, as the worker running it would have"""
+        bridge = self.bridge
+        error = bridge.EncodeSignal(bridge.SignalRuntimeError) + bridge.EncodeString(problem)
+        bridge.SendFrame(bridge.SignalPoolOutput, bridge.EncodeInt(requestId) + EncodeLEB(len(error)) + error, requestId)
+        bridge.SendFrame(bridge.SignalPoolCallComplete, bridge.EncodeInt(requestId) + b"\x00", requestId)
+
+    def Submit(self, requestId, affinity, call, encoding):
+        while True:
+            workers = [w for w in self.workers if w.alive]
+            if not workers:
+                raise Exception("Every worker in the pool has exited, the call to " + call.Namespace + " can not be run!")
+            worker = self.workers[affinity % len(self.workers)] if affinity >= 0 else None
+            if worker is None or not worker.alive:
+                worker = min(workers, key=lambda w: w.outstanding)
+            with worker.lock:
+                # The relay may have found that it exited since we chose it
+                if not worker.alive:
+                    continue
+                try:
+                    worker.connection.send((requestId, encoding, call.Namespace, call.ParameterNames, call.ParameterList))
+                except (IOError, OSError, ValueError) as inst:
+                    worker.alive = False
+                    raise Exception("Unable to send the call to " + call.Namespace + " to worker %d: %s" % (worker.index, inst))
+                worker.outstanding += 1
+                worker.pending.add(requestId)
+                return
+
+    def Close(self):
+        for worker in self.workers:
+            try:
+                worker.connection.send(None)
+            except Exception:
+                pass
+        for worker in self.workers:
+            worker.process.join(60)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            # let the relay pass on everything the worker sent before it exited
+            if worker.relay is not None:
+                worker.relay.join(60)
+            worker.connection.close()
+        self.workers = []
+
+def RunPoolWorker(projectFile, userInitials, databankName, connection):
+    """The entry point of each process in a ModellerWorkerPool"""
+    sendLock = threading.Lock()
+    emmeApplication = None
+    try:
+        emmeApplication = _app.start_dedicated(visible=False, user_initials=userInitials, project=projectFile)
+        bridge = XTMFBridge.__new__(XTMFBridge)
+        bridge.InitializeState(userInitials)
+        output = PoolWorkerStream(connection, sendLock)
+        bridge.Writer = XTMFOutputWriter(bridge, output)
+        bridge.Writer.start()
+        bridge.AttachModeller(emmeApplication, databankName)
+        sys.stdout = RedirectToXTMFConsole(bridge)
+    except Exception as e:
+        connection.send(("failed", str(e)))
+        if emmeApplication is not None:
+            emmeApplication.close()
+        return
+    connection.send(("ready", None))
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+        requestId, encoding, namespace, parameterNames, parameterList = message
+        bridge.StringEncoding = encoding
+        output.RequestId = requestId
+        success = bridge.RunModuleCall(ModuleCall(namespace, parameterNames, parameterList, typed=True))
+        # everything the call produced needs to be relayed before we say that it is done
+        bridge.Writer.Flush()
+        with sendLock:
+            connection.send(("done", requestId, success))
+    sys.stdout = NullStream()
+    bridge.Writer.Close()
+    emmeApplication.close()
+
+class LogbookEntry:
+    __slots__ = ("Name", "Attributes", "Value", "IsTrace", "Children", "Repeats", "Size", "Key")
+
+    def __init__(self, name, attributes, value, isTrace):
+        self.Name = name
+        self.Attributes = attributes
+        self.Value = value
+        self.IsTrace = isTrace
+        self.Children = []
+        self.Repeats = 0
+        self.Size = 1
+        # Set once the entry is complete, it is used to find repeats
+        self.Key = None
+
+# Stands in for Modeller's logbook_write and logbook_trace while buffering is
+# on.  Entries are kept in memory as a tree of traces and written to the real
+# logbook together when a tool finishes, or between top level entries once
+# there are more than MaxEntries of them.  An entry that repeats the one before
+# it, with the same contents, is written once with a count.  A namespace can be
+# sampled so that only one in every N of the top level entries written while its
+# tool runs are kept.  Arguments asked for with save_arguments are not kept,
+# Modeller reads them from the caller's frame which is gone by the time we write.
+class LogbookBuffer:
+    def __init__(self, write, trace, maxEntries=10000, sampleRates=None):
+        self._write = write
+        self._trace = trace
+        self.MaxEntries = maxEntries
+        self.SampleRates = sampleRates or {}
+        self.Namespace = None
+        self._roots = []
+        self._count = 0
+        self._seen = {}
+        self._skipped = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+
+    def _Stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _Sample(self):
+        # Must be called while holding the lock
+        namespace = self.Namespace
+        rate = self.SampleRates.get(namespace, 1)
+        if rate <= 1:
+            return True
+        seen = self._seen.get(namespace, 0)
+        self._seen[namespace] = seen + 1
+        if seen % rate == 0:
+            return True
+        self._skipped[namespace] = self._skipped.get(namespace, 0) + 1
+        return False
+
+    def _Begin(self, entry, stack):
+        """Add the entry under the open trace, returns False if it is not being kept"""
+        with self._lock:
+            if stack:
+                parent = stack[-1]
+                if parent is None:
+                    return False
+                parent.Children.append(entry)
+            else:
+                if not self._Sample():
+                    return False
+                self._roots.append(entry)
+            self._count += 1
+        return True
+
+    def _End(self, entry, stack):
+        entry.Size = 1 + sum(child.Size for child in entry.Children)
+        try:
+            key = (entry.IsTrace, entry.Name, repr(entry.Attributes), repr(entry.Value), tuple(child.Key for child in entry.Children))
+        except Exception:
+            key = (id(entry),)
+        with self._lock:
+            siblings = stack[-1].Children if stack else self._roots
+            if len(siblings) >= 2 and siblings[-1] is entry and siblings[-2].Key == key:
+                siblings[-2].Repeats += 1 + entry.Repeats
+                siblings.pop()
+                self._count -= entry.Size
+            else:
+                entry.Key = key
+            full = not stack and self._count >= self.MaxEntries
+        if full:
+            self.Flush()
+
+    def Write(self, name, attributes=None, value=None):
+        stack = self._Stack()
+        entry = LogbookEntry(name, attributes, value, False)
+        if self._Begin(entry, stack):
+            self._End(entry, stack)
+
+    @contextmanager
+    def Trace(self, name, attributes=None, value=None, save_arguments=None):
+        stack = self._Stack()
+        entry = LogbookEntry(name, attributes, value, True)
+        kept = self._Begin(entry, stack)
+        stack.append(entry if kept else None)
+        try:
+            yield None
+        finally:
+            stack.pop()
+            if kept:
+                self._End(entry, stack)
+
+    def Flush(self):
+        """Write the finished top level entries to the logbook, in the order they were made"""
+        with self._flushLock:
+            with self._lock:
+                finished = 0
+                while finished < len(self._roots) and self._roots[finished].Key is not None:
+                    finished += 1
+                roots = self._roots[:finished]
+                del self._roots[:finished]
+                self._count -= sum(root.Size for root in roots)
+                skipped = self._skipped
+                self._skipped = {}
+            for root in roots:
+                self._Replay(root)
+            for namespace, count in skipped.items():
+                self._write("Sampling skipped %d logbook entries from %s" % (count, namespace))
+
+    def _Replay(self, entry):
+        name = entry.Name
+        if entry.Repeats > 0:
+            name = "%s (repeated %d times)" % (name, entry.Repeats + 1)
+        if not entry.IsTrace:
+            self._write(name, attributes=entry.Attributes, value=entry.Value)
+            return
+        with self._trace(name, attributes=entry.Attributes, value=entry.Value):
+            for child in entry.Children:
+                self._Replay(child)
+
 def RedirectLogbookWrite(name, attributes=None, value=None):
     pass
 
@@ -91,11 +1857,46 @@ def RedirectLogbookTrace(name, attributes=None, value=None, save_arguments=None)
     finally:
         pass
 
+# Installed in Modeller as logbook_write and logbook_trace while a bridge is
+# buffering the logbook.  Tools can keep their own reference to them, so they
+# look up the bridge's current buffer each time they are called and go to
+# Modeller's own functions once it is no longer buffering.
+_LogbookBridge = None
+_LogbookOriginals = None
+
+def InstallLogbookForwarders(bridge):
+    global _LogbookBridge, _LogbookOriginals
+    if _LogbookOriginals is None:
+        _LogbookOriginals = (_m.logbook_write, _m.logbook_trace)
+    _LogbookBridge = bridge
+    _m.logbook_write = ForwardLogbookWrite
+    _m.logbook_trace = ForwardLogbookTrace
+
+def RemoveLogbookForwarders():
+    if _LogbookOriginals is not None:
+        _m.logbook_write, _m.logbook_trace = _LogbookOriginals
+
+def ForwardLogbookWrite(name, attributes=None, value=None):
+    logbookBuffer = _LogbookBridge.LogbookBuffer if _LogbookBridge is not None else None
+    if logbookBuffer is None:
+        return _LogbookOriginals[0](name, attributes=attributes, value=value)
+    return logbookBuffer.Write(name, attributes, value)
+
+def ForwardLogbookTrace(name, attributes=None, value=None, save_arguments=None):
+    logbookBuffer = _LogbookBridge.LogbookBuffer if _LogbookBridge is not None else None
+    if logbookBuffer is None:
+        if save_arguments is None:
+            return _LogbookOriginals[1](name, attributes=attributes, value=value)
+        return _LogbookOriginals[1](name, attributes=attributes, value=value, save_arguments=save_arguments)
+    return logbookBuffer.Trace(name, attributes, value, save_arguments)
+
 class XTMFBridge:
     """The stream used for sending data to XTMF"""
     ToXTMF = None
     """The stream used for getting data from XTMF"""
     FromXTMF = None
+    """The connection to XTMF that both of the streams use"""
+    Transport = None
     """Our link to the EMME modeller"""
     Modeller = None
     """The name of the field that XTMF enabled Modeller Tools will use"""
@@ -134,12 +1935,76 @@ class XTMFBridge:
     SignalStartModuleBinaryParameters = 14
     """Signal from XTMF to check all loaded toolboxes to ensure that all unconsolidated tools actually point to a real script file."""
     SignalCheckForMissingTools = 15
+    """Signal from XTMF to run a list of tools back to back using binary parameters"""
+    SignalStartModuleBatch = 16
+    """Tell XTMF that the following messages belong to the given entry of the batch"""
+    SignalBatchEntry = 17
+    """Tell XTMF that we have finished the batch, followed by the number of entries that were executed"""
+    SignalBatchComplete = 18
+    """Signal from XTMF to copy a matrix from Emme into a shared memory channel"""
+    SignalExportMatrixToChannel = 19
+    """Signal from XTMF to copy a matrix from a shared memory channel into Emme"""
+    SignalImportMatrixFromChannel = 20
+    """Signal from XTMF that it no longer needs a shared memory channel that we have created"""
+    SignalReleaseMatrixChannel = 21
+    """Signal from XTMF to start up a tool where each parameter is sent with its type and native encoding"""
+    SignalStartModuleTypedParameters = 22
+    """Tell XTMF that the following bytes are the next chunk of a typed return value"""
+    SignalTypedResultChunk = 23
+    """Tell XTMF that we have successfully ran the requested tool and all chunks of its typed return value have been sent"""
+    SignalRunCompleteWithTypedResult = 24
+    """Signal from XTMF with the highest protocol version and the string encodings it supports"""
+    SignalNegotiateProtocol = 25
+    """Tell XTMF the protocol version and string encoding that both sides will use from now on"""
+    SignalProtocolAccepted = 26
+    """Signal from XTMF asking for the timing of each phase of the tool calls so far, returned as JSON"""
+    SignalGetPerformanceReport = 27
+    """Signal from XTMF to append the timing of each phase of the tool calls so far to a JSON lines file"""
+    SignalDumpPerformanceReport = 28
+    """Signal from XTMF to profile the next number of tool calls, optionally only for the given namespaces"""
+    SignalStartProfiling = 29
+    """Signal from XTMF to collect the profiles that have been captured"""
+    SignalGetProfiles = 30
+    """Tell XTMF the profiles that have been captured, each with its namespace, format and data"""
+    SignalProfileResults = 31
+    """Signal from XTMF to set how many tool results to remember and for which namespaces"""
+    SignalConfigureResultCache = 32
+    """Signal from XTMF to forget the remembered tool results for the given namespaces, or all of them"""
+    SignalInvalidateResultCache = 33
+    """Signal from XTMF to set the memory budget in MB of the scenario data cache and the namespaces of tools that do not change scenarios"""
+    SignalConfigureDataCache = 34
+    """Signal from XTMF to start a pool of Emme applications, one for each of the given project files"""
+    SignalStartWorkerPool = 35
+    """Signal from XTMF to shut down the pool of Emme applications"""
+    SignalStopWorkerPool = 36
+    """Signal from XTMF to run a tool with typed parameters on the pool, with a request id and the affinity for a worker"""
+    SignalStartModuleOnPool = 37
+    """Tell XTMF what a pool worker sent for the given request id, in version 3 the frame is tagged with it too"""
+    SignalPoolOutput = 38
+    """Tell XTMF that the given request id has finished on the pool, and if it was successful"""
+    SignalPoolCallComplete = 39
+    """Signal from XTMF to cancel the tool running for a request id, or whatever is running for -1"""
+    SignalCancelTool = 40
+    """Signal from XTMF to set the timeout in milliseconds for the tool calls after it, and the grace period for cancelled tools"""
+    SignalSetToolTimeout = 41
+    """Signal from XTMF to empty the logbook while Emme keeps running, first copying it to the given path if it is not empty"""
+    SignalRotateLogbook = 42
+    """Signal from XTMF to turn buffering of logbook entries on or off, with the flush size and sample rates for namespaces"""
+    SignalConfigureLogbookBuffer = 43
+    """Signal from XTMF to check a list of tool namespaces and the parameter names it will send to each, replying with a report in JSON"""
+    SignalPreflightTools = 44
+
+    """The highest protocol version that this bridge understands, version 3 frames every message with a request id and length"""
+    ProtocolVersion = 3
+    """The table of the Modeller logbook holding its entries, and the column other tables use to refer to them"""
+    LogbookEntryTable = "entries"
+    LogbookEntryColumn = "entry_id"
+    """The string encodings we support, by the name used in the negotiation, in order of preference"""
+    SupportedEncodings = {"utf-8": "utf-8", "utf-16": "utf-16-le"}
         
     """Initialize the bridge so that the tools that we run will not accidentally access the standard I/O"""
-    def __init__(self, emmeApplication, databankName):
-        self.CachedLogbookWrite = _m.logbook_write
-        self.CachedLogbookTrace = _m.logbook_trace
-        self.previous_level = None
+    def __init__(self, emmeApplication, databankName, pipeName, userInitials="XTMF"):
+        self.InitializeState(userInitials)
 
         # Redirect sys.stdout
         sys.stdin.close()
@@ -147,26 +2012,95 @@ class XTMFBridge:
         if emmeApplication is not None:
             # Load up Modeller before continuing on
             try:
-                self.emmeApplication = emmeApplication
-                if databankName is not None:
-                    self.SwitchToDatabank(emmeApplication, databankName)
-                self.Modeller = inro.modeller.Modeller(emmeApplication)
+                self.AttachModeller(emmeApplication, databankName)
                 _m.logbook_write("Activated modeller from ModellerBridge for XTMF")
             except:
                 #Terminate the bridge if we are unable to
                 terminate = True
         else:
             terminate = True
-        self.ToXTMF = open('\\\\.\\pipe\\' + pipeName, 'wb', 0)
-        self.FromXTMF = os.fdopen(0, "rb")
+        self.Connect(OpenTransport(pipeName))
         sys.stdout = NullStream()
-        self.IOLock = threading.Lock()
         sys.stdin = None
         sys.stdout = RedirectToXTMFConsole(self)
         if terminate:
             exit(-1)
         return
 
+    def InitializeState(self, userInitials):
+        """Set up everything the bridge keeps between calls, independent of how it talks to XTMF"""
+        self.UserInitials = userInitials
+        # Modeller's own functions, even if another bridge has already installed its forwarders
+        self.CachedLogbookWrite, self.CachedLogbookTrace = _LogbookOriginals or (_m.logbook_write, _m.logbook_trace)
+        self.previous_level = None
+        self._ToolSignatures = {}
+        self._AttributeTypes = None
+        self._MatrixChannels = {}
+        self.Performance = PerformanceRecorder(False)
+        self.Profiler = ToolProfiler()
+        self.ResultCache = ToolResultCache()
+        self.DataCache = EmmeDataCache()
+        self.NegotiatedVersion = 1
+        self.StringEncoding = "utf-16-le"
+        self.DatabankName = None
+        self.WorkerPool = None
+        self._Request = threading.local()
+        self._ExecutingRequestId = 0
+        self.ToolTimeout = 0.0
+        self.CancelGracePeriod = 10.0
+        self._RunningCancellation = None
+        self._CancelledRequests = {}
+        self._IdleToken = CancellationToken()
+        # Guards the cancellation state, CancelTool runs on the thread reading the requests
+        self._CancelLock = threading.Lock()
+        self._QueuedRequests = set()
+        self._ActiveRequestId = None
+        self._PendingCancelReason = None
+        self.LogbookBuffer = None
+        self.Recorder = None
+        self.ToolboxValidator = ToolboxValidator()
+        return
+
+    @property
+    def CancellationToken(self):
+        """For tools, the token that is set when XTMF cancels the running tool"""
+        cancellation = self._RunningCancellation
+        if cancellation is None:
+            return self._IdleToken
+        return cancellation.Token
+
+    @property
+    def Reader(self):
+        """The payload of the request being handled by this thread, or the stream from XTMF"""
+        reader = getattr(self._Request, "Reader", None)
+        if reader is None:
+            return self._StreamReader
+        return reader
+
+    @Reader.setter
+    def Reader(self, reader):
+        self._StreamReader = reader
+
+    def Connect(self, transport):
+        """Send and receive everything through the given transport"""
+        self.Transport = transport
+        self.ToXTMF = transport
+        self.Writer = XTMFOutputWriter(self, self.ToXTMF)
+        self.Writer.start()
+        self.FromXTMF = transport
+        self.Reader = XTMFInputBuffer(self.FromXTMF)
+        return
+
+    def AttachModeller(self, emmeApplication, databankName):
+        """Load up Modeller for the given Emme application"""
+        self.emmeApplication = emmeApplication
+        self.DatabankName = databankName
+        if databankName is not None:
+            self.SwitchToDatabank(emmeApplication, databankName)
+        self.Modeller = inro.modeller.Modeller(emmeApplication)
+        self.ToolNamespaces = ToolNamespaceIndex(self.Modeller)
+        return
+
     def GetToolParameters(self, tool):
         if six.PY3:
             return inspect.getfullargspec(tool.__call__)[0][1:]
@@ -174,74 +2108,72 @@ class XTMFBridge:
             return inspect.getargspec(tool.__call__)[0][1:]
     
     def ReadLEB(self):
-        ret = 0
-        Continue = True
-        Continues = 0
-        bitIndex = 0
-        while Continue:
-            #unsigned array
-            byteArray = array.array('B')
-            byteArray.fromfile(self.FromXTMF, 1)
-            current = byteArray.pop()
-            if current < 128:
-                Continue = False
-            else:
-                current -= 128
-            # Add together the numbers
-            ret = ret + (current << bitIndex)
-            bitIndex += 7
-            #ret = (ret << 7) + current
-        return ret
+        return self.Reader.ReadLEB()
         
     def ReadString(self):
-        # The byte length will be twice the number of characters
-        stringArray = array.array('u')
-        length = self.ReadLEB() >> (stringArray.itemsize >> 1)
-        try:
-            stringArray.fromfile(self.FromXTMF, length)
-            ret = stringArray.tounicode()
-            return ret
-        except Exception as e:
-            print(str(stringArray))
-            print(str(e))
-            return stringArray.tounicode()
+        return self.Reader.ReadString()
     
     def ReadInt(self):
-        intArray = array.array('l')
-        intArray.fromfile(self.FromXTMF, 1)
-        return intArray.pop()
+        return self.Reader.ReadInt()
     
+    def ReadNamespaceList(self):
+        """Read a comma separated list of tool namespaces"""
+        return [ns.strip() for ns in self.ReadString().split(",") if ns.strip()]
+
     def IsWhitespace(self, c):
         return (c == ' ') or (c == '\t') or (c == '\s')
     
     def CreateTool(self, toolName):
         return self.Modeller.tool(toolName)
     
-    def GetToolParameterTypes(self, tool):
+    def GetAttributeTypes(self):
+        # Compare against the types Modeller uses for its attributes, these only need to be built once
+        if self._AttributeTypes is None:
+            self._AttributeTypes = [(_m.Attribute(float).type, "float"),
+                                    (_m.Attribute(int).type, "int"),
+                                    (_m.Attribute(str).type, "string"),
+                                    (_m.Attribute(bool).type, "bool")]
+        return self._AttributeTypes
+
+    def GetToolSignature(self, tool):
+        signature, error = self.ResolveToolSignature(tool)
+        if signature is None:
+            _m.logbook_write(error)
+            self.SendParameterError(error)
+        return signature
+
+    def ResolveToolSignature(self, tool):
+        """Returns the signature of the tool and None, or None and the reason that it can not be called by XTMF"""
+        toolClass = tool.__class__
+        signature = self._ToolSignatures.get(toolClass)
+        if signature is not None and signature.IsCurrent():
+            return signature, None
         # get the names of the parameters
         parameterNames = self.GetToolParameters(tool)
-        ret = []
+        parameterTypes = []
+        attributeTypes = self.GetAttributeTypes()
         for param in parameterNames:
-            try:
-                paramVar = eval("tool.__class__." + str(param))
-            except:
-                _m.logbook_write("A parameter with the name '" + param + "' does not exist in the executing EMME tool!  Make sure that the EMME tool defines this attribute as a class variable.")
-                self.SendParameterError("A parameter with the name '" + param + "' does not exist in the executing EMME tool!  Make sure that the EMME tool defines this attribute as a class variable.")
-                return None
+            paramVar = getattr(toolClass, str(param), None)
+            if paramVar is None:
+                return None, "A parameter with the name '" + param + "' does not exist in the executing EMME tool!  Make sure that the EMME tool defines this attribute as a class variable."
             typeOfParam = paramVar.type
-            if typeOfParam == _m.Attribute(float).type:
-                ret.append("float")
-            elif typeOfParam == _m.Attribute(int).type:
-                ret.append("int")
-            elif typeOfParam == _m.Attribute(str).type:
-                ret.append("string")
-            elif typeOfParam == _m.Attribute(bool).type:
-                ret.append("bool")
-            else:
-                _m.logbook_write(param + " uses a type unsupported by the ModellerBridge '" + str(typeOfParam) + "'!")
-                self.SendParameterError(param + " uses a type unsupported by the ModellerBridge '" + str(typeOfParam) + "'!")
-                return None
-        return ret 
+            typeName = None
+            for attributeType, name in attributeTypes:
+                if typeOfParam == attributeType:
+                    typeName = name
+                    break
+            if typeName is None:
+                return None, param + " uses a type unsupported by the ModellerBridge '" + str(typeOfParam) + "'!"
+            parameterTypes.append(typeName)
+        signature = ToolSignature(toolClass, parameterNames, parameterTypes)
+        self._ToolSignatures[toolClass] = signature
+        return signature, None
+
+    def GetToolParameterTypes(self, tool):
+        signature = self.GetToolSignature(tool)
+        if signature is None:
+            return None
+        return list(signature.ParameterTypes)
     
     def BreakIntoParametersStrings(self, parameterString):
         parameterList = []
@@ -294,144 +2226,139 @@ class XTMFBridge:
         if length != len(toolParameterTypes):
             return None
         for i in range(length):
-            if toolParameterTypes[i] == "int":
+            typeName = toolParameterTypes[i]
+            if typeName not in ParameterConverters:
+                self.SendParameterError("The type '" + typeName + "' is not recognized by this XTMF Bridge for parameter "+ parameterNames[i] +"!")
+                return None
+            converter, description = ParameterConverters[typeName]
+            #strings are already a string, so we don't need to do anything
+            if converter is not None:
                 try:
-                    parameterList[i] = int(parameterList[i])
+                    parameterList[i] = converter(parameterList[i])
                 except:
-                    self.SendParameterError("Unable to convert '" + parameterList[i] + "' to an integer for parameter "+ parameterNames[i] +"!")
+                    self.SendParameterError("Unable to convert '" + parameterList[i] + "' to " + description + " for parameter "+ parameterNames[i] +"!")
                     return None
-            elif toolParameterTypes[i] == "string":
-                #it is already a string, so we don't need to do anything
+        return parameterList
+    
+    def ConvertTypedValues(self, parameterList, toolParameterTypes, parameterNames):
+        for i in range(len(parameterList)):
+            value = parameterList[i]
+            typeName = toolParameterTypes[i]
+            if isinstance(value, six.text_type):
+                # Strings are parsed the same way as the untyped parameters
+                converter, description = ParameterConverters[typeName]
+                if converter is not None:
+                    try:
+                        parameterList[i] = converter(value)
+                    except:
+                        self.SendParameterError("Unable to convert '" + value + "' to " + description + " for parameter "+ parameterNames[i] +"!")
+                        return None
+            elif typeName == "string":
+                # Blobs are handed to the tool as they are
+                if not isinstance(value, bytes):
+                    parameterList[i] = str(value)
+            elif typeName == "bool" and isinstance(value, bool):
+                pass
+            elif typeName == "float" and isinstance(value, (float,) + six.integer_types) and not isinstance(value, bool):
+                parameterList[i] = float(value)
+            elif typeName == "int" and isinstance(value, six.integer_types) and not isinstance(value, bool):
                 pass
-            elif toolParameterTypes[i] == "float":
-                try:
-                    parameterList[i] = float(parameterList[i])
-                except:
-                    self.SendParameterError("Unable to convert '" + parameterList[i] + "' to a float for parameter "+ parameterNames[i] +"!")
-                    return None
-            elif toolParameterTypes[i] == "bool":
-                try:
-                    if parameterList[i].lower() in ['true','t','tru','tr']:
-                        parameterList[i] = True
-                    elif parameterList[i].lower() in ['false','f','fals','fal']:
-                        parameterList[i] = False
-                    else:
-                        self.SendParameterError("Unable to convert '" + parameterList[i] + "' to a bool for parameter "+ parameterNames[i] +"!")
-                except:
-                    self.SendParameterError("Unable to convert '" + parameterList[i] + "' to a bool for parameter "+ parameterNames[i] +"!")
-                    return None
             else:
-                self.SendParameterError("The type '" + toolParameterTypes[i] + "' is not recognized by this XTMF Bridge for parameter "+ parameterNames[i] +"!")
+                self.SendParameterError("Unable to use the " + type(value).__name__ + " value '" + str(value) + "' as " + ParameterConverters[typeName][1] + " for parameter "+ parameterNames[i] +"!")
                 return None
         return parameterList
     
-    def BuildCallString(self, toolName, parameterListName, length):
-        string = toolName + "("
-        for i in range(length):
-            if i > 0:
-                string += ','
-            string += parameterListName + "[" + str(i) + "]"
-        string += ")"
-        return string
-    
-    def SendString(self, stringToSend):
-        msg = array.array('u', six.text_type(stringToSend))
-        length = len(msg) * msg.itemsize
-        tempLength = length
-        bytes = 0
-        #figure out how many bytes we are going to need to store the length
-        #string
-        while tempLength > 0:
-            tempLength = tempLength >> 7
-            bytes += 1
-        lengthArray = array.array('B')
-        if length <= 0:
-            lengthArray.append(0)
-        else:
-            tempLength = length
-            for i in range(bytes):
-                current = int(tempLength >> 7)
-                current = int(current << 7)
-                diff = tempLength - current
-                if tempLength < 128:
-                    lengthArray.append(diff)
-                else:
-                    lengthArray.append(diff + 128)
-                tempLength = tempLength >> 7
-        lengthArray.tofile(self.ToXTMF)
-        msg.tofile(self.ToXTMF)
+    _Int32 = struct.Struct("<i")
+
+    def EncodeText(self, text):
+        # Lone surrogates are sent as they are, as the array('u') we used to write strings with did
+        return six.text_type(text).encode(self.StringEncoding, "surrogatepass")
+
+    def EncodeString(self, stringToSend):
+        msg = self.EncodeText(stringToSend)
+        return EncodeLEB(len(msg)) + msg
+
+    def EncodeInt(self, value):
+        return self._Int32.pack(value)
+
+    def EncodeSignal(self, signal):
+        return self._Int32.pack(signal)
+
+    _FrameHeader = struct.Struct("<iii")
+
+    def EncodeMessage(self, signal, payload, requestId):
+        if self.NegotiatedVersion >= 3:
+            return self._FrameHeader.pack(signal, requestId, len(payload)) + payload
+        return self.EncodeSignal(signal) + payload
+
+    def CurrentRequestId(self):
+        """The request that a reply from this thread belongs to, when it is not handling one it is the executing tool's"""
+        requestId = getattr(self._Request, "Id", None)
+        if requestId is None:
+            return self._ExecutingRequestId
+        return requestId
+
+    def SendFrame(self, signal, payload=b"", requestId=None):
+        """Send a reply, in version 3 tagged with the given request id or else the one this thread is answering"""
+        if requestId is None:
+            requestId = self.CurrentRequestId()
+        self.Writer.Send(self.EncodeMessage(signal, payload, requestId))
         return
     
     def SendToolDoesNotExistError(self, namespace):
-        self.IOLock.acquire()
-        self.SendSignal(self.SignalSendToolDoesNotExistsError)
-        self.SendString("A tool with the following namespace could not be found: %s" % namespace)
-        self.ToXTMF.flush()
-        self.IOLock.release()
+        message = "A tool with the following namespace could not be found: %s\r\n%s" % (namespace, self.ToolNamespaces.DescribeMissing(namespace))
+        self.SendFrame(self.SignalSendToolDoesNotExistsError, self.EncodeString(message))
         return
 
     def SendParameterError(self, problem):
-        self.IOLock.acquire()
-        self.SendSignal(self.SignalParameterError)
-        self.SendString(problem)
-        self.ToXTMF.flush()
-        self.IOLock.release()
+        self.SendFrame(self.SignalParameterError, self.EncodeString(problem))
         return
         
     def SendRuntimeError(self, problem):
-        self.IOLock.acquire()
-        self.SendSignal(self.SignalRuntimeError)
-        self.SendString(problem)
-        self.ToXTMF.flush()
-        self.IOLock.release()
+        self.SendFrame(self.SignalRuntimeError, self.EncodeString(problem))
         return
     
     def SendSuccess(self):
-        self.IOLock.acquire()
-        intArray = array.array('l')
-        intArray.append(self.SignalRunComplete)
-        intArray.tofile(self.ToXTMF)
-        self.ToXTMF.flush()
-        self.IOLock.release()
+        self.SendFrame(self.SignalRunComplete)
         return
     
     def SendReturnSuccess(self, returnValue):
-        self.IOLock.acquire()
-        self.SendSignal(self.SignalRunCompleteWithParameter)
-        self.SendString(str(returnValue))
-        self.ToXTMF.flush()
-        self.IOLock.release()
+        self.SendFrame(self.SignalRunCompleteWithParameter, self.EncodeString(str(returnValue)))
         return
     
+    def SendTypedReturnSuccess(self, returnValue, chunkSize=65536):
+        # Split the encoded value into chunks so that large results are never held in memory all at once
+        chunk = bytearray()
+        for piece in EncodeTypedValue(returnValue):
+            piece = memoryview(piece)
+            offset = 0
+            while offset < len(piece):
+                take = min(chunkSize - len(chunk), len(piece) - offset)
+                chunk += piece[offset:offset + take]
+                offset += take
+                if len(chunk) == chunkSize:
+                    self.SendFrame(self.SignalTypedResultChunk, EncodeLEB(len(chunk)) + bytes(chunk))
+                    chunk = bytearray()
+        if len(chunk) > 0:
+            self.SendFrame(self.SignalTypedResultChunk, EncodeLEB(len(chunk)) + bytes(chunk))
+        self.SendFrame(self.SignalRunCompleteWithTypedResult)
+        return
+
     def SendSignal(self, signal):
-        intArray = array.array('l')
-        intArray.append(signal)
-        intArray.tofile(self.ToXTMF)
+        self.SendFrame(signal)
         return
     
     def SendPrintSignal(self, stringToPrint):
-        self.IOLock.acquire()
-        self.SendSignal(self.SignalSendPrintMessage)
-        self.SendString(stringToPrint)
-        self.ToXTMF.flush()
-        self.IOLock.release()
+        self.Writer.Print(stringToPrint, self.CurrentRequestId())
         return
 
     def ReportProgress(self, progress):
-        self.IOLock.acquire()
-        self.SendSignal(self.SignalProgressReport)
-        floatArray = array.array('f')
-        floatArray.append(float(progress))
-        floatArray.tofile(self.ToXTMF)
-        self.ToXTMF.flush()
-        self.IOLock.release()   
+        self.Writer.Progress(progress, self.CurrentRequestId())
         return
 
     def EnsureModellerToolExists(self, macroName):
-        for i in range(1, 10):
-            if macroName in self.Modeller.tool_namespaces():       
-                return True
-            time.sleep(1)
+        if self.ToolNamespaces.Contains(macroName):
+            return True
         _m.logbook_write("A tool with the following namespace could not be found: %s" % macroName)
         self.SendToolDoesNotExistError(macroName)
         return False
@@ -477,123 +2404,506 @@ class XTMFBridge:
                 return False
         return True
     
+    def ReadModuleCall(self, useBinaryParameters):
+        #figure out how long the macro's name is
+        macroName = self.ReadString()
+        # Read in the parameters from XTMF (This needs to happen first so we don't get out of sync).
+        if useBinaryParameters:
+            #Read in the number of strings, one for each parameter
+            numberOfParameters = int(self.ReadString())
+            sentParameterNames = [self.ReadString() for p in range(0, numberOfParameters)]
+            parameterList = [self.ReadString() for p in range(0, numberOfParameters)]
+            return ModuleCall(macroName, sentParameterNames, parameterList)
+        return ModuleCall(macroName, parameterString=self.ReadString())
+
+    def ReadTypedModuleCall(self):
+        macroName = self.ReadString()
+        numberOfParameters = self.ReadInt()
+        sentParameterNames = []
+        parameterList = []
+        for p in range(0, numberOfParameters):
+            sentParameterNames.append(self.ReadString())
+            parameterList.append(self.Reader.ReadTypedValue())
+        return ModuleCall(macroName, sentParameterNames, parameterList, typed=True)
+
     def ExecuteModule(self, useBinaryParameters):
-        macroName = None
-        parameterString = None
+        timing = self.Performance.StartCall()
+        try:
+            call = self.ReadModuleCall(useBinaryParameters)
+        except Exception:
+            self.SendExecutionError(None)
+            return False
+        timing.Mark("decode")
+        return self.RunModuleCall(call, timing)
+
+    def ExecuteTypedModule(self):
+        timing = self.Performance.StartCall()
+        try:
+            call = self.ReadTypedModuleCall()
+        except Exception:
+            self.SendExecutionError(None)
+            return False
+        timing.Mark("decode")
+        return self.RunModuleCall(call, timing)
+
+    def ExecuteModuleBatch(self):
+        try:
+            numberOfCalls = self.ReadInt()
+            stopOnError = self.ReadInt() != 0
+            calls = [self.ReadModuleCall(True) for i in range(numberOfCalls)]
+        except Exception:
+            self.SendExecutionError(None)
+            return False
+        executed = 0
+        success = True
+        for index, call in enumerate(calls):
+            with self._CancelLock:
+                cancelReason = self._PendingCancelReason
+            if cancelReason is not None:
+                _m.logbook_write("The batch was stopped after %d of %d calls because %s" % (executed, numberOfCalls, cancelReason))
+                success = False
+                break
+            # Let XTMF know which entry the following messages belong to
+            self.SendFrame(self.SignalBatchEntry, self.EncodeInt(index))
+            executed += 1
+            if not self.RunModuleCall(call):
+                success = False
+                if stopOnError:
+                    break
+        self.SendFrame(self.SignalBatchComplete, self.EncodeInt(executed))
+        return success
+
+    def StartWorkerPool(self):
+        projectFiles = [self.ReadString() for i in range(self.ReadInt())]
+        try:
+            self.StopWorkerPool()
+            self.WorkerPool = ModellerWorkerPool(self, projectFiles, self.UserInitials, self.DatabankName)
+            self.SendSuccess()
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+        return
+
+    def StopWorkerPool(self):
+        if self.WorkerPool is not None:
+            self.WorkerPool.Close()
+            self.WorkerPool = None
+        return
+
+    def StopWorkerPoolAndReply(self):
+        self.StopWorkerPool()
+        self.SendSuccess()
+        return
+
+    def ExecuteModuleOnPool(self):
+        requestId = self.ReadInt()
+        affinity = self.ReadInt()
+        try:
+            call = self.ReadTypedModuleCall()
+        except Exception:
+            self.SendExecutionError(None)
+            return
+        if self.WorkerPool is not None:
+            # The tool may write to the emmebank at any time until it completes
+            self.DataChanged()
+            try:
+                self.WorkerPool.Submit(requestId, affinity, call, self.StringEncoding)
+            except Exception as inst:
+                _m.logbook_write(str(inst))
+                self.SendRuntimeError(str(inst))
+                self.SendFrame(self.SignalPoolCallComplete, self.EncodeInt(requestId) + b"\x00")
+            return
+        # Without a pool the call runs here, its replies are sent untagged and followed by the completion
+        success = self.RunModuleCall(call)
+        self.SendFrame(self.SignalPoolCallComplete, self.EncodeInt(requestId) + (b"\x01" if success else b"\x00"))
+        return
+
+    def RunModuleCall(self, call, timing=None):
+        recorder = self.Recorder
+        if recorder is None:
+            return self._RunModuleCall(call, timing)
+        start = timeit.default_timer()
+        success = False
+        try:
+            success = self._RunModuleCall(call, timing)
+            return success
+        finally:
+            recorder.RecordCall(call, start, timeit.default_timer() - start, success)
+
+    def _RunModuleCall(self, call, timing):
+        macroName = call.Namespace
         timer = None
+        if timing is None:
+            timing = self.Performance.StartCall()
         # run the module here
         try:
-            #figure out how long the macro's name is
-            macroName = self.ReadString()
             if not self.EnsureModellerToolExists(macroName):
-                return
-
-            # Read in the parameters from XTMF (This needs to happen first so we don't get out of sync).
-            if useBinaryParameters:
-                #Read in the number of strings, one for each parameter
-                numberOfParameters = int(self.ReadString())
-                sentParameterNames = [self.ReadString() for p in range(0, numberOfParameters)]
-                parameterList = [self.ReadString() for p in range(0, numberOfParameters)]
-            else:
-                parameterString = self.ReadString()
-                
+                return False
+            timing.Mark("namespace")
             
             # Now we can create the tool
-            tool = self.CreateTool(macroName)
-            toolParameterTypes = self.GetToolParameterTypes(tool)
-            if toolParameterTypes == None:
-                return
+            try:
+                tool = self.CreateTool(macroName)
+            except Exception:
+                # The tool might have been removed from its toolbox since we indexed it
+                self.ToolNamespaces.Invalidate()
+                if not self.EnsureModellerToolExists(macroName):
+                    return False
+                raise
+            timing.Mark("create")
+            signature = self.GetToolSignature(tool)
+            if signature == None:
+                return False
+            call.Signature = signature
+            toolParameterTypes = signature.ParameterTypes
+            timing.Mark("types")
 
             # Parse the parameters
-            expectedParameterNames = self.GetToolParameters(tool)
-            if useBinaryParameters:
+            expectedParameterNames = signature.ParameterNames
+            if call.ParameterNames is not None:
+                sentParameterNames = call.ParameterNames
+                parameterList = call.ParameterList
                 if not self.ReorderParametersToMatch(macroName, expectedParameterNames, sentParameterNames, parameterList):
-                    return
-                parameterString = str.join(',', ['{%s:%s}' %(sentParameterNames[p], parameterList[p]) for p in range(0, numberOfParameters)])
+                    return False
             else:
-                parameterList = self.BreakIntoParametersStrings(parameterString)
+                parameterList = self.BreakIntoParametersStrings(call.ParameterString)
             
-            parameterList = self.ConvertIntoTypes(parameterList, toolParameterTypes, expectedParameterNames)
+            if call.Typed:
+                parameterList = self.ConvertTypedValues(parameterList, toolParameterTypes, expectedParameterNames)
+            else:
+                parameterList = self.ConvertIntoTypes(parameterList, toolParameterTypes, expectedParameterNames)
             if parameterList == None:
                 _m.logbook_write("We were unable to create the parameters to their given types, or there was the wrong number of arguments for the tool " + macroName + ".")
-                _m.logbook_write("The parameter string was \r\n" + parameterString)
+                _m.logbook_write("The parameter string was \r\n" + call.DescribeParameters())
                 self.SendParameterError("The module \"" + macroName + "\" was executed with the wrong number of arguments or of invalid types.")
-                return
-            parameterNames = self.GetToolParameters(tool)
-            #Do the exec in another namespace
-            nameSpace = {'tool':tool, 'parameterNames':parameterNames, 'parameterList':parameterList}
-            for i in range(len(parameterList)):
-                if toolParameterTypes[i] == "string":
-                    toExecute = "tool." + parameterNames[i] + "='" + str(parameterList[i]).replace("\\","\\\\").replace("'","\\'").replace("\"","\\\"") + "'"
-                else:
-                    toExecute = "tool." + parameterNames[i] + "=" + str(parameterList[i])
-                exec(toExecute, nameSpace, {})
-            callString = self.BuildCallString("tool", "parameterList", len(parameterList))
+                return False
+            timing.Mark("convert")
+            cacheKey = None
+            if self.ResultCache.IsCacheable(macroName):
+                cacheKey = self.ResultCache.MakeKey(macroName, parameterList, getattr(self.Modeller.emmebank, "path", None))
+                found, ret = self.ResultCache.Get(cacheKey)
+                if found:
+                    self.SendToolResult(call, ret)
+                    timing.Mark("queue")
+                    return True
+            elif macroName not in self.DataCache.ReadOnlyNamespaces:
+                self.ResultCache.DataChanged()
             #Now that everything is ready, attach an instance of ourselves into
             #the tool so they can send progress reports
             tool.XTMFBridge = self
             
+            # XTMF may have cancelled the request while we were getting the tool ready
+            with self._CancelLock:
+                cancelReason = self._PendingCancelReason
+                if cancelReason is None:
+                    cancellation = ToolCancellation(threading.current_thread().ident, self.ToolTimeout, self.CancelGracePeriod)
+                    self._RunningCancellation = cancellation
+            if cancelReason is not None:
+                self.SendToolCancelled(macroName, cancelReason)
+                return False
             if "percent_completed" in dir(tool):
                 timer = ProgressTimer(tool.percent_completed, self)
                 timer.start()
             #Execute the tool, getting the return value
-            ret = eval(callString, nameSpace, None)
-            if timer != None:
-                timer.stop()
+            logbookBuffer = self.LogbookBuffer
+            if logbookBuffer is not None:
+                logbookBuffer.Namespace = macroName
+            try:
+                try:
+                    if self.Profiler.ShouldProfile(macroName):
+                        ret = self.Profiler.Profile(macroName, signature.Invoke, tool, parameterList, timing)
+                    else:
+                        ret = signature.Invoke(tool, parameterList, timing)
+                finally:
+                    # Any progress report has to reach XTMF before the tool's reply
+                    if timer != None:
+                        timer.stop()
+                    cancellation.Finish()
+                    self._RunningCancellation = None
+                    self.DataCache.ToolFinished(macroName)
+                    if logbookBuffer is not None:
+                        logbookBuffer.Namespace = None
+                        logbookBuffer.Flush()
+            except ToolCancelledError:
+                self.SendToolCancelled(macroName, cancellation.Token.Reason)
+                return False
+            if cancellation.Token.IsCancelled:
+                # The tool noticed and returned early, what it returned is not a real result
+                self.SendToolCancelled(macroName, cancellation.Token.Reason)
+                return False
+            timing.Mark("run")
+            if cacheKey is not None:
+                self.ResultCache.Put(cacheKey, ret)
             
-            nameSpace = None
-            if ret == None: 
-                self.SendSuccess()
-            else:
-                self.SendReturnSuccess(ret)
+            self.SendToolResult(call, ret)
+            timing.Mark("queue")
+            return True
         except Exception as inst:
-            if timer != None:
-                timer.stop()
-            _m.logbook_write("We are in the exception code for ExecuteModule")
-            if(macroName != None):
-                _m.logbook_write("Macro Name: " + macroName)
-            else:
-                _m.logbook_write("Macro Name: None")
-            if(parameterString != None):
-                _m.logbook_write("Parameter : " + parameterString)
-            else:
-                _m.logbook_write("Parameter : None")
-            _m.logbook_write(str(inst))
+            self.SendExecutionError(call)
+            return False
+        finally:
+            timing.Finish(macroName)
+
+    def SendToolCancelled(self, macroName, reason):
+        _m.logbook_write("The tool " + macroName + " was cancelled because " + str(reason))
+        self.SendRuntimeError("The tool " + macroName + " was cancelled because " + str(reason))
+        return
+
+    def CancelTool(self):
+        requestId = self.ReadInt()
+        cancelled = False
+        with self._CancelLock:
+            cancellation = self._RunningCancellation
+            activeRequestId = self._ActiveRequestId
+            if requestId == -1 or (activeRequestId is not None and requestId == activeRequestId):
+                if activeRequestId is not None:
+                    # This lasts for the rest of the request, a tool that has not started yet is
+                    # cancelled before it is called and a batch stops before its next entry
+                    self._PendingCancelReason = "XTMF cancelled it"
+                    cancelled = True
+                if cancellation is not None:
+                    cancelled = cancellation.Cancel("XTMF cancelled it") or cancelled
+            elif requestId in self._QueuedRequests:
+                # It has not started yet, it will be skipped when it gets to the front of the queue
+                self._CancelledRequests[requestId] = "XTMF cancelled it"
+                cancelled = True
+        self.SendReturnSuccess(cancelled)
+        return
+
+    def CancelAllRequests(self, reason):
+        """Cancel the running tool and every request waiting behind it, each is answered as it leaves the queue"""
+        with self._CancelLock:
+            for requestId in self._QueuedRequests:
+                self._CancelledRequests[requestId] = reason
+            if self._ActiveRequestId is not None:
+                self._PendingCancelReason = reason
+            if self._RunningCancellation is not None:
+                self._RunningCancellation.Cancel(reason)
+        return
+
+    def SetToolTimeout(self):
+        self.ToolTimeout = self.ReadInt() / 1000.0
+        self.CancelGracePeriod = self.ReadInt() / 1000.0
+        self.SendSuccess()
+        return
+
+    def SendToolResult(self, call, ret):
+        if ret is None:
+            self.SendSuccess()
+        elif call.Typed:
+            self.SendTypedReturnSuccess(ret)
+        else:
+            self.SendReturnSuccess(ret)
+        return
+
+    def GetNetwork(self, scenario):
+        """For tools, get the network of the scenario shared between tool calls.  It must not be modified,
+        use scenario.get_network() for a copy that can be changed."""
+        return self.DataCache.GetNetwork(scenario)
+
+    def GetCachedData(self, scenario, key, factory, size=None):
+        """For tools, get a value read from the scenario that is kept between tool calls until the scenario changes"""
+        return self.DataCache.Get(scenario, key, factory, size)
+
+    def ScenarioChanged(self, scenario):
+        """For tools, report a change to the scenario that was not made through the scenario's own methods"""
+        self.DataCache.ScenarioChanged(scenario)
+
+    def SendExecutionError(self, call):
+        """Report the exception currently being handled to the logbook and to XTMF"""
+        etype, evalue, etb = sys.exc_info()
+        _m.logbook_write("We are in the exception code for ExecuteModule")
+        if(call != None):
+            _m.logbook_write("Macro Name: " + call.Namespace)
+        else:
+            _m.logbook_write("Macro Name: None")
+        if(call != None and call.DescribeParameters() != None):
+            _m.logbook_write("Parameter : " + call.DescribeParameters())
+        else:
+            _m.logbook_write("Parameter : None")
+        _m.logbook_write(str(evalue))
 
-            etype, evalue, etb = sys.exc_info()
-            stackList = _traceback.extract_tb(etb)
-            msg = "%s: %s\n\nStack trace below:" % (evalue.__class__.__name__, str(evalue))
-            stackList.reverse()
-            for file, line, func, text in stackList:
-                msg += "\n  File '%s', line %s, in %s" % (file, line, func)
-            self.SendRuntimeError(msg)
+        stackList = _traceback.extract_tb(etb)
+        msg = "%s: %s\n\nStack trace below:" % (evalue.__class__.__name__, str(evalue))
+        stackList.reverse()
+        for file, line, func, text in stackList:
+            msg += "\n  File '%s', line %s, in %s" % (file, line, func)
+        self.SendRuntimeError(msg)
         return
     
     def CleanLogbook(self):
         try:
-            projectFile = None
+            self.EmptyLogbook(None)
+            self.SendSuccess()
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+        return
+
+    def RotateLogbook(self):
+        archivePath = self.ReadString()
+        try:
+            self.SendReturnSuccess(self.EmptyLogbook(archivePath if archivePath else None))
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+        return
+
+    def EmptyLogbook(self, archivePath):
+        """Empty the logbook, returning "truncated" if it was done in place or "restarted" if Emme had to be restarted"""
+        logbookPath = self.Modeller.desktop.modeller_logbook_url
+        try:
+            self.TruncateLogbook(logbookPath, archivePath)
+            # Make sure that Modeller can still write to what is left, going around any buffer of the entries
+            self.CachedLogbookWrite("Logbook rotated by XTMF")
+            if self.CountLogbookEntries(logbookPath) == 0:
+                raise Exception("Modeller did not write to the logbook after it was truncated")
+            return "truncated"
+        except Exception:
+            # It is locked or Modeller could not use it afterwards, fall back to starting Emme without it
+            pass
+        if archivePath is not None and not exists(archivePath):
+            shutil.copyfile(logbookPath, archivePath)
+        self.RestartWithoutLogbook(logbookPath)
+        return "restarted"
+
+    def TruncateLogbook(self, logbookPath, archivePath, busyTimeout=5.0):
+        """Delete every entry from the logbook's SQLite database through a second connection, Modeller keeps its own"""
+        connection = sqlite3.connect(logbookPath, timeout=busyTimeout)
+        try:
+            if archivePath is not None:
+                archive = sqlite3.connect(archivePath)
+                try:
+                    if hasattr(connection, "backup"):
+                        connection.backup(archive)
+                    else:
+                        archive.executescript(str.join(";\n", connection.iterdump()))
+                finally:
+                    archive.close()
+            with connection:
+                for table in self.GetLogbookEntryTables(connection):
+                    connection.execute('DELETE FROM "%s"' % table.replace('"', '""'))
+            try:
+                connection.execute("VACUUM")
+            except sqlite3.OperationalError:
+                # Modeller is reading it right now, the freed pages will be reused instead
+                pass
+        finally:
+            connection.close()
+        return
+
+    def GetLogbookEntryTables(self, connection):
+        """The entry table and the tables whose rows belong to an entry, every other table describes the logbook itself"""
+        tables = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        if self.LogbookEntryTable not in tables:
+            raise Exception("The logbook does not have an '" + self.LogbookEntryTable + "' table, it has: " + str.join(", ", tables))
+        entryTables = [self.LogbookEntryTable]
+        for table in tables:
+            columns = [row[1] for row in connection.execute('PRAGMA table_info("%s")' % table.replace('"', '""'))]
+            if table != self.LogbookEntryTable and self.LogbookEntryColumn in columns:
+                entryTables.append(table)
+        return entryTables
+
+    def CountLogbookEntries(self, logbookPath, busyTimeout=5.0):
+        connection = sqlite3.connect(logbookPath, timeout=busyTimeout)
+        try:
+            return connection.execute('SELECT COUNT(*) FROM "%s"' % self.LogbookEntryTable).fetchone()[0]
+        finally:
+            connection.close()
+
+    def RestartWithoutLogbook(self, logbookPath, releaseTimeout=60.0):
+        """Close Emme, delete the logbook once Emme lets go of it and then start Emme again"""
+        projectFile = self.FindProjectFile()
+        self.Modeller = None
+        self.DataCache.Clear()
+        self._ToolSignatures = {}
+        self.emmeApplication.close()
+        self.emmeApplication = None
+        # Emme can take a while to release the file after closing, try until it lets us delete it
+        deadline = time.time() + releaseTimeout
+        delay = 0.05
+        while exists(logbookPath):
+            try:
+                os.remove(logbookPath)
+            except OSError:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        self.AttachModeller(_app.start_dedicated(visible=False, user_initials=self.UserInitials, project=projectFile), self.DatabankName)
+        return
+
+    def FindProjectFile(self):
+        try:
+            return self.emmeApplication.project_file_name()
+        except Exception:
+            pass
+        projectFiles = glob.glob("*.emp")
+        if len(projectFiles) == 0:
+            os.chdir("..")
             projectFiles = glob.glob("*.emp")
-            if len(projectFiles) > 0:
-                projectFile = projectFiles[0]
-            if projectFile == None:
-                os.chdir("..")
-                projectFiles = glob.glob("*.emp")
-                if len(projectFiles) > 0:
-                    projectFile = projectFiles[0]
-            logbookPath = self.Modeller.desktop.modeller_logbook_url
-            self.Modeller = None
-            self.emmeApplication.close()
-            self.emmeApplication = None
+        return projectFiles[0] if len(projectFiles) > 0 else None
             
-            time.sleep(10)
-            os.remove(logbookPath)
-            self.emmeApplication = _app.start_dedicated(visible=False, user_initials="XTMF", project=projectFile)
-            self.Modeller = inro.modeller.Modeller(self.emmeApplication)
+    def GetMatrix(self, matrixId, scenarioNumber):
+        emmebank = self.Modeller.emmebank
+        matrix = emmebank.matrix(matrixId)
+        scenario = emmebank.scenario(scenarioNumber) if scenarioNumber >= 0 else None
+        return matrix, scenario
+
+    def ExportMatrixToChannel(self):
+        matrixId = self.ReadString()
+        scenarioNumber = self.ReadInt()
+        channelName = self.ReadString()
+        try:
+            if _np is None:
+                raise Exception("NumPy is required to transfer matrices through shared memory!")
+            matrix, scenario = self.GetMatrix(matrixId, scenarioNumber)
+            if matrix is None:
+                raise Exception("The matrix " + matrixId + " does not exist!")
+            data = matrix.get_numpy_data(scenario.id if scenario is not None else None)
+            size = MatrixChannel.Header.size + data.nbytes
+            # Keep the channel alive until XTMF releases it, reusing it if it is large enough
+            channel = self._MatrixChannels.get(channelName)
+            if channel is not None and channel.Size < size:
+                channel.Close()
+                channel = None
+            if channel is None:
+                channel = MatrixChannel(channelName, size)
+                self._MatrixChannels[channelName] = channel
+            self.SendReturnSuccess(channel.SetData(data))
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+        return
+
+    def ImportMatrixFromChannel(self):
+        matrixId = self.ReadString()
+        scenarioNumber = self.ReadInt()
+        channelName = self.ReadString()
+        channel = None
+        try:
+            if _np is None:
+                raise Exception("NumPy is required to transfer matrices through shared memory!")
+            matrix, scenario = self.GetMatrix(matrixId, scenarioNumber)
+            self.DataChanged()
+            if matrix is None:
+                matrix = self.Modeller.emmebank.create_matrix(matrixId)
+            channel = self._MatrixChannels.get(channelName)
+            if channel is None:
+                channel = MatrixChannel(channelName)
+            # the view into the channel must not outlive this call or the channel can not be closed
+            matrix.set_numpy_data(channel.GetData(), scenario.id if scenario is not None else None)
             self.SendSuccess()
         except Exception as inst:
             self.SendRuntimeError(str(inst))
+        finally:
+            if channel is not None and channelName not in self._MatrixChannels:
+                channel.Close()
         return
-            
+
+    def ReleaseMatrixChannel(self):
+        channel = self._MatrixChannels.pop(self.ReadString(), None)
+        if channel is not None:
+            channel.Close()
+        self.SendSuccess()
+        return
+
     def SwitchToDatabank(self, emmeApplication, databankName):
         databankName = databankName.lower()
         for db in emmeApplication.data_explorer().databases():
@@ -603,119 +2913,334 @@ class XTMFBridge:
         self.SendRuntimeError("The databank " + databankName + " does not exist!")
 
     def CheckForMissingTools(self):
-        def get_tool_namespace(toolbox, elementIndex):
-            element = toolbox.element(elementIndex)
-            if element["parent_id"] is None:
-                return element["attributes"]["namespace"]
-            return get_tool_namespace(toolbox, element["parent_id"]) + "." + element["attributes"]["namespace"]
-        
-        def does_tool_exist(toolbox, elementIndex):
-            element = toolbox.element(elementIndex)
-            if element is None:
-                return False
-            attributes = element["attributes"]
-            # If it is a directory the code attribute does not exist
-            if not ("code" in attributes):
-                return True
-            # If code exists and is not None, then the tool exists
-            if attributes["code"]:
-                return True
-            # Check to see if the script exists
-            script = attributes["script"]
-            if not script:
-                raise Exception("There is no file path for the unconsolidated tool " + get_tool_namespace(toolbox, elementIndex) + " defined!")
-            if not exists(script):
-                raise Exception("The unconsolidated tool \"" + get_tool_namespace(toolbox, elementIndex) + "\" calls a file that does not exist \""+script+"\"!")
-            return True
-
-        def read_children(childStr):
-            ret = [int(x) for x in childStr[1:len(childStr)-1].split(",")]
-            return ret
-
-        def explore_toolbox(toolbox, index):
-            element = toolbox.element(index)
-            if element is None:
-                raise Exception("The given element " + str(index) + " does not exist in the toolbox!")
-            if "attributes" not in element:
-                raise Exception("The element does not have any attributes " + str(index))
-            attributes = element["attributes"]
-            if "children" in attributes:
-                for childIndex in read_children(attributes["children"]):
-                    explore_toolbox(toolbox, childIndex)
-            else:
-                does_tool_exist(toolbox, index)
-        
-        for toolbox in self.Modeller.toolboxes:
-            try:
-                explore_toolbox(toolbox, toolbox.root)
-            except Exception as e:
-                self.SendRuntimeError(str(e))
-                return False
+        self.ToolNamespaces.Invalidate()
+        try:
+            errors = self.ToolboxValidator.Validate(self.Modeller.toolboxes)
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+            return False
+        if errors:
+            self.SendRuntimeError(str.join("\r\n", errors))
+            return False
         self.SendSignal(self.SignalRunComplete)
         return True
 
-    def Run(self, performanceMode):
+    def Run(self, performanceMode, capturePath=None):
         if performanceMode:
             _m.logbook_write("Performance Testing Activated")
+            self.Performance.Enabled = True
+        if capturePath:
+            self.StartCapture(capturePath)
         # now that everything has been redirected we can
         # tell XTMF that we are ready
         self.SendSignal(self.SignalStart)
-        self.ToXTMF.flush()
-        exit = False
-        while(not exit):
+        try:
+            self.RunLoop()
+        finally:
+            self.StopWorkerPool()
+            self.StopBufferingLogbook()
+            # make sure everything we have queued makes it to XTMF before we leave
+            self.Writer.Close()
+            if self.Transport is not None:
+                self.Transport.close()
+            if self.Recorder is not None:
+                self.Recorder.Close()
+                self.Recorder = None
+        return
+
+    def StartCapture(self, path):
+        """Record everything sent between XTMF and the bridge from now on, this must happen before anything has been read"""
+        self.Recorder = SessionRecorder(path)
+        recording = RecordingTransport(self.Transport, self.Recorder)
+        self.Writer.stream = recording
+        self._StreamReader.stream = recording
+        _m.logbook_write("Recording the session with XTMF to " + path)
+        return
+
+    def GetSignalHandlers(self):
+        """Map each signal from XTMF to its handler and if it has to wait for the tools before it to finish"""
+        return {
+            self.SignalStartModule: (lambda: self.ExecuteModule(False), True),
+            self.SignalStartModuleBinaryParameters: (lambda: self.ExecuteModule(True), True),
+            self.SignalStartModuleTypedParameters: (self.ExecuteTypedModule, True),
+            self.SignalStartModuleBatch: (self.ExecuteModuleBatch, True),
+            self.SignalExportMatrixToChannel: (self.ExportMatrixToChannel, True),
+            self.SignalImportMatrixFromChannel: (self.ImportMatrixFromChannel, True),
+            self.SignalReleaseMatrixChannel: (self.ReleaseMatrixChannel, True),
+            self.SignalNegotiateProtocol: (self.NegotiateProtocol, True),
+            self.SignalGetPerformanceReport: (self.SendPerformanceReport, False),
+            self.SignalDumpPerformanceReport: (self.DumpPerformanceReport, False),
+            self.SignalStartProfiling: (self.StartProfiling, True),
+            self.SignalGetProfiles: (self.SendProfiles, False),
+            self.SignalConfigureResultCache: (self.ConfigureResultCache, True),
+            self.SignalInvalidateResultCache: (self.InvalidateResultCache, True),
+            self.SignalConfigureDataCache: (self.ConfigureDataCache, True),
+            self.SignalStartWorkerPool: (self.StartWorkerPool, True),
+            self.SignalStopWorkerPool: (self.StopWorkerPoolAndReply, True),
+            self.SignalStartModuleOnPool: (self.ExecuteModuleOnPool, True),
+            self.SignalCleanLogbook: (self.CleanLogbook, True),
+            self.SignalCheckToolExists: (self.CheckToolExists, False),
+            self.SignalDisableLogbook: (self.DisableLogbook, False),
+            self.SignalEnableLogbook: (self.EnableLogbook, False),
+            self.SignalCheckForMissingTools: (self.CheckForMissingTools, True),
+            self.SignalCancelTool: (self.CancelTool, False),
+            self.SignalRotateLogbook: (self.RotateLogbook, True),
+            self.SignalConfigureLogbookBuffer: (self.ConfigureLogbookBuffer, True),
+            self.SignalSetToolTimeout: (self.SetToolTimeout, True),
+            self.SignalPreflightTools: (self.PreflightTools, True),
+        }
+
+    def RunLoop(self):
+        handlers = self.GetSignalHandlers()
+        while True:
+            if self.NegotiatedVersion >= 3:
+                self.RunFramedLoop(handlers)
+                return
             try:
                 input = self.ReadInt()
             except  Exception as inst:
-                exit = True
                 sys.stdout = NullStream()
                 # this is because the bridge was closed on the XTMF side
                 return
             if input == self.SignalTermination:
                 _m.logbook_write("Exiting on termination signal from XTMF")
-                exit = True
                 sys.stdout = NullStream()
                 return
-            elif input == self.SignalStartModule:
-                if performanceMode:
-                    t = timeit.Timer(self.ExecuteModule).timeit(1)
-                    _m.logbook_write(str(t) + " seconds to execute.")
-                else:
-                    self.ExecuteModule(False)
-            elif input == self.SignalStartModuleBinaryParameters:
-                if performanceMode:
-                    t = timeit.Timer(self.ExecuteModule).timeit(1)
-                    _m.logbook_write(str(t) + " seconds to execute.")
-                else:
-                    self.ExecuteModule(True)
-            elif input == self.SignalCleanLogbook:
-                self.CleanLogbook()
-            elif input == self.SignalCheckToolExists:
-                self.CheckToolExists()
-            elif input == self.SignalDisableLogbook:
-                self.DisableLogbook()
-            elif input == self.SignalEnableLogbook:
-                self.EnableLogbook()
-            elif input == self.SignalCheckForMissingTools:
-                self.CheckForMissingTools()
-            else:
+            handler = handlers.get(input)
+            if handler is None:
                 #If we do not understand what XTMF is saying quietly die
-                exit = True
                 _m.logbook_write("Exiting on bad input \"" + str(input) + "\"")
                 try:
                     self.SendSignal(self.SignalTermination)
                 except Exception as e:
                     pass
                 sys.stdout = NullStream()
+                return
+            # As in HandleRequest, a failing handler is reported instead of ending the bridge
+            try:
+                handler[0]()
+            except Exception as inst:
+                self.SendRuntimeError("Unable to handle signal " + str(input) + ": " + str(inst))
+
+    def RunFramedLoop(self, handlers):
+        """Tools keep running in order on this thread while another reads the requests and answers the control ones right away"""
+        # The protocol can not be changed once messages are framed
+        handlers = dict(handlers)
+        del handlers[self.SignalNegotiateProtocol]
+        requests = six.moves.queue.Queue()
+        reader = Thread(target=self.ReadRequests, args=(requests, handlers))
+        reader.daemon = True
+        reader.start()
+        while True:
+            request = requests.get()
+            if request is None:
+                break
+            requestId, payload, handler = request
+            with self._CancelLock:
+                self._QueuedRequests.discard(requestId)
+                skipped = self._CancelledRequests.pop(requestId, None)
+                if skipped is None:
+                    self._ExecutingRequestId = requestId
+                    self._ActiveRequestId = requestId
+                    self._PendingCancelReason = None
+            if skipped is not None:
+                self.HandleRequest(requestId, payload, lambda: self.SendRuntimeError("The request was cancelled before it started because " + skipped))
+                continue
+            try:
+                self.HandleRequest(requestId, payload, handler)
+            finally:
+                with self._CancelLock:
+                    self._ActiveRequestId = None
+                    self._PendingCancelReason = None
+        sys.stdout = NullStream()
+        return
+
+    def ReadRequests(self, requests, handlers):
+        try:
+            while True:
+                try:
+                    signal, requestId, payload = self._StreamReader.ReadFrame()
+                except Exception:
+                    # this is because the bridge was closed on the XTMF side
+                    return
+                if signal == self.SignalTermination:
+                    _m.logbook_write("Exiting on termination signal from XTMF")
+                    self.CancelAllRequests("XTMF is closing the bridge")
+                    return
+                handler = handlers.get(signal)
+                if handler is None:
+                    # The frame tells us where the next message starts so we can keep going
+                    self.HandleRequest(requestId, payload, lambda: self.SendRuntimeError("Unknown signal " + str(signal)))
+                elif handler[1]:
+                    with self._CancelLock:
+                        self._QueuedRequests.add(requestId)
+                    requests.put((requestId, payload, handler[0]))
+                else:
+                    self.HandleRequest(requestId, payload, handler[0])
+        finally:
+            requests.put(None)
+
+    def HandleRequest(self, requestId, payload, handler):
+        reader = XTMFInputBuffer(io.BytesIO(payload), max(len(payload), 64))
+        reader.SetEncoding(self.StringEncoding)
+        self._Request.Id = requestId
+        self._Request.Reader = reader
+        try:
+            handler()
+        except Exception as inst:
+            self.SendRuntimeError("Unable to handle request " + str(requestId) + ": " + str(inst))
+        finally:
+            self._Request.Id = None
+            self._Request.Reader = None
+        return
+
+    def SendPerformanceReport(self):
+        self.SendReturnSuccess(json.dumps(self.Performance.Report()))
+        return
+
+    def DataChanged(self):
+        """The emmebank was changed outside of the tools we run, nothing read from it before can be reused"""
+        self.ResultCache.DataChanged()
+        self.DataCache.Clear()
+        return
+
+    def ConfigureResultCache(self):
+        capacity = self.ReadInt()
+        self.ResultCache.Configure(capacity, self.ReadNamespaceList())
+        self.SendSuccess()
+        return
+
+    def InvalidateResultCache(self):
+        self.ResultCache.Invalidate(self.ReadNamespaceList())
+        self.SendSuccess()
+        return
+
+    def ConfigureDataCache(self):
+        self.DataCache.Budget = self.ReadInt() * 1048576
+        self.DataCache.ReadOnlyNamespaces = set(self.ReadNamespaceList())
+        self.DataCache.Clear()
+        self.SendSuccess()
+        return
+
+    def DumpPerformanceReport(self):
+        path = self.ReadString()
+        try:
+            self.Performance.DumpJsonLines(path)
+            self.SendSuccess()
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+        return
+
+    def StartProfiling(self):
+        count = self.ReadInt()
+        namespaces = self.ReadNamespaceList()
+        profileFormat = self.ReadString()
+        try:
+            self.Profiler.Arm(count, namespaces, profileFormat)
+            self.SendSuccess()
+        except Exception as inst:
+            self.SendRuntimeError(str(inst))
+        return
+
+    def SendProfiles(self):
+        results = self.Profiler.TakeResults()
+        payload = bytearray(self.EncodeInt(len(results)))
+        for namespace, profileFormat, data in results:
+            payload += self.EncodeString(namespace)
+            payload += self.EncodeString(profileFormat)
+            payload += EncodeLEB(len(data))
+            payload += data
+        self.SendFrame(self.SignalProfileResults, bytes(payload))
+        return
+
+    def NegotiateProtocol(self):
+        requestedVersion = self.ReadInt()
+        offeredEncodings = [e.strip().lower() for e in self.ReadString().split(",")]
+        version = max(1, min(requestedVersion, self.ProtocolVersion))
+        encodingName = "utf-16"
+        if version >= 2:
+            for offered in offeredEncodings:
+                if offered in self.SupportedEncodings:
+                    encodingName = offered
+                    break
+        # The reply is still in the old encoding, and everything queued before it has to be written before we switch
+        self.SendFrame(self.SignalProtocolAccepted, self.EncodeInt(version) + self.EncodeString(encodingName))
+        self.Writer.Flush()
+        self.NegotiatedVersion = version
+        self.StringEncoding = self.SupportedEncodings[encodingName]
+        self.Reader.SetEncoding(self.StringEncoding)
         return
 
     def CheckToolExists(self):
         ns = self.ReadString()
-        ret = ns in self.Modeller.tool_namespaces()
+        ret = self.ToolNamespaces.Contains(ns)
         if ret == False:
             _m.logbook_write("Unable to find a tool named " + ns)
         self.SendReturnSuccess(ret)
         return
     
+    def PreflightTools(self):
+        try:
+            tools = []
+            for i in range(self.ReadInt()):
+                namespace = self.ReadString()
+                tools.append((namespace, [self.ReadString() for p in range(self.ReadInt())]))
+        except Exception:
+            self.SendExecutionError(None)
+            return False
+        report = [self.PreflightTool(namespace, sentParameterNames) for namespace, sentParameterNames in tools]
+        compatible = all(entry["compatible"] for entry in report)
+        if not compatible:
+            _m.logbook_write("Preflight found %i of %i tools that XTMF will not be able to call" % (len([entry for entry in report if not entry["compatible"]]), len(report)))
+        self.SendReturnSuccess(json.dumps({"compatible": compatible, "tools": report}))
+        return compatible
+
+    def PreflightTool(self, namespace, sentParameterNames):
+        """Resolve the tool as a call to it would and compare its parameters to the ones XTMF will send"""
+        entry = {"namespace": namespace, "found": False, "compatible": False, "error": None,
+                 "parameters": [], "missing": [], "unexpected": []}
+        if not self.ToolNamespaces.Contains(namespace):
+            entry["error"] = "A tool with the following namespace could not be found: " + namespace
+            return entry
+        entry["found"] = True
+        try:
+            # This also leaves the tool's signature cached for when it is called
+            signature, error = self.ResolveToolSignature(self.CreateTool(namespace))
+        except Exception as inst:
+            signature, error = None, str(inst)
+        if signature is None:
+            entry["error"] = error
+            return entry
+        expectedParameterNames = list(signature.ParameterNames)
+        entry["parameters"] = [{"name": name, "type": parameterType} for name, parameterType in zip(expectedParameterNames, signature.ParameterTypes)]
+        entry["missing"] = [name for name in expectedParameterNames if name not in sentParameterNames]
+        entry["unexpected"] = [name for name in sentParameterNames if name not in expectedParameterNames]
+        entry["compatible"] = not entry["missing"] and not entry["unexpected"]
+        return entry
+
+    def ConfigureLogbookBuffer(self):
+        enabled = self.ReadInt() != 0
+        maxEntries = self.ReadInt()
+        sampleRates = {}
+        for i in range(self.ReadInt()):
+            namespace = self.ReadString()
+            sampleRates[namespace] = self.ReadInt()
+        self.StopBufferingLogbook()
+        if enabled:
+            self.LogbookBuffer = LogbookBuffer(self.CachedLogbookWrite, self.CachedLogbookTrace, maxEntries, sampleRates)
+            InstallLogbookForwarders(self)
+        self.SendSuccess()
+        return
+
+    def StopBufferingLogbook(self):
+        logbookBuffer = self.LogbookBuffer
+        if logbookBuffer is not None:
+            # Anything still holding the forwarders goes to Modeller's logbook before the last entries are written
+            RemoveLogbookForwarders()
+            self.LogbookBuffer = None
+            logbookBuffer.Flush()
+        return
+
     def DisableLogbook(self):
         self.previous_level = inro.modeller.logbook_level()
         _m.logbook_level(inro.modeller.LogbookLevel.NONE)
@@ -725,31 +3250,37 @@ class XTMFBridge:
     
 #end XTMFBridge
 
-#Get the project file
-args = sys.argv # 0: This script's location, 1: Emme project file, 2: User initials, 3:
-                # Performance flag
-projectFile = args[1]
-userInitials = args[2]
-performancFlag = bool(int(args[3]))
-pipeName = args[4]
-databank = None
-if len(args) > 5:
-    databank = args[5]
-#sys.stderr.write(args)
-print(userInitials)
-print(projectFile)
-TheEmmeEnvironmentXMTF = None
-try:
-    TheEmmeEnvironmentXMTF = _app.start_dedicated(visible=False, user_initials=userInitials, project=projectFile)
-except:
-    # We can just pass here, if we didn't set the environment then the bridge will terminate
-    pass 
+def main():
+    #Get the project file
+    args = sys.argv # 0: This script's location, 1: Emme project file, 2: User initials, 3:
+                    # Performance flag
+    projectFile = args[1]
+    userInitials = args[2]
+    performancFlag = bool(int(args[3]))
+    pipeName = args[4]
+    databank = None
+    if len(args) > 5:
+        databank = args[5]
+    #sys.stderr.write(args)
+    print(userInitials)
+    print(projectFile)
+    TheEmmeEnvironmentXMTF = None
+    try:
+        TheEmmeEnvironmentXMTF = _app.start_dedicated(visible=False, user_initials=userInitials, project=projectFile)
+    except:
+        # We can just pass here, if we didn't set the environment then the bridge will terminate
+        pass 
     
-try:
-    XTMFBridge(TheEmmeEnvironmentXMTF, databank,).Run(performancFlag)
-except Exception as e:   
-    print(dir(e).__class__)
-    print(e.message)
-    print(e.args)
-if TheEmmeEnvironmentXMTF is not None:
-    TheEmmeEnvironmentXMTF.close()
+    try:
+        # Setting XTMF_BRIDGE_CAPTURE to a file path records the session for ModellerBridgeBenchmark.py --replay
+        XTMFBridge(TheEmmeEnvironmentXMTF, databank, pipeName, userInitials).Run(performancFlag, os.environ.get("XTMF_BRIDGE_CAPTURE"))
+    except Exception as e:   
+        print(dir(e).__class__)
+        print(e.message)
+        print(e.args)
+    if TheEmmeEnvironmentXMTF is not None:
+        TheEmmeEnvironmentXMTF.close()
+
+# Pool workers load this script again, only the process started by XTMF runs the bridge
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,691 @@
+﻿'''
+    Copyright 2026 Travel Modelling Group, Department of Civil Engineering, University of Toronto
+
+    This file is part of XTMF.
+
+    XTMF is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    XTMF is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with XTMF.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+# Measures the overhead that ModellerBridge adds to each tool call without
+# needing Emme.  Stand-ins for inro.modeller and inro.emme.desktop are put in
+# sys.modules before the bridge is imported, and XTMF is played by this script
+# over a socket pair.  Results are written as JSON so that two runs can be
+# compared:
+#
+#   python ModellerBridgeBenchmark.py --output before.json
+#   python ModellerBridgeBenchmark.py --compare before.json
+#
+# A session recorded by running the bridge with XTMF_BRIDGE_CAPTURE set can be
+# played back into a bridge whose tools are stubs with the recorded parameters:
+#
+#   python ModellerBridgeBenchmark.py --replay session.trace [--replay-timing recorded]
+#
+# The parts of the protocol that XTMF has to opt into, the negotiated versions
+# and encodings, framed replies, cancellation and typed values, are checked the
+# same way, exiting with 1 if any of them fail:
+#
+#   python ModellerBridgeBenchmark.py --check
+
+from __future__ import print_function
+import sys
+import os
+import io
+import json
+import time
+import types
+import socket
+import argparse
+import platform
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+# The most precise clock we have, Python 2 does not have perf_counter
+Clock = time.perf_counter if hasattr(time, "perf_counter") else time.time
+
+class StandInAttribute(object):
+    def __init__(self, attributeType, *args, **kwargs):
+        self.type = attributeType
+
+class StandInTool(object):
+    pass
+
+class StandInLogbookLevel:
+    NONE = 0
+    TRACE = 1
+    LOG = 2
+
+# Plays the part of inro.modeller.Modeller, tools are looked up in StandInTools
+class StandInModeller(object):
+    def __init__(self, emmeApplication=None):
+        self.emmeApplication = emmeApplication
+        self.emmebank = None
+        self.desktop = None
+        self.toolboxes = []
+
+    def tool_namespaces(self):
+        return list(StandInTools)
+
+    def tool(self, namespace):
+        return StandInTools[namespace]()
+
+StandInTools = {}
+_logbookLevel = [StandInLogbookLevel.LOG]
+
+def StandInLogbookWrite(name, attributes=None, value=None):
+    pass
+
+@contextmanager
+def StandInLogbookTrace(name, attributes=None, value=None, save_arguments=None):
+    yield None
+
+def StandInLogbookLevelFunction(level=None):
+    if level is None:
+        return _logbookLevel[0]
+    _logbookLevel[0] = level
+
+def StandInStartDedicated(**kwargs):
+    raise Exception("Emme is not available while benchmarking the bridge!")
+
+def InstallModellerStandIn():
+    """Put the stand-ins for the Emme modules into sys.modules so that the bridge can be imported"""
+    inro = types.ModuleType("inro")
+    modeller = types.ModuleType("inro.modeller")
+    modeller.Attribute = StandInAttribute
+    modeller.Tool = StandInTool
+    modeller.Modeller = StandInModeller
+    modeller.LogbookLevel = StandInLogbookLevel
+    modeller.logbook_write = StandInLogbookWrite
+    modeller.logbook_trace = StandInLogbookTrace
+    modeller.logbook_level = StandInLogbookLevelFunction
+    emme = types.ModuleType("inro.emme")
+    desktop = types.ModuleType("inro.emme.desktop")
+    app = types.ModuleType("inro.emme.desktop.app")
+    app.start_dedicated = StandInStartDedicated
+    inro.modeller = modeller
+    inro.emme = emme
+    emme.desktop = desktop
+    desktop.app = app
+    sys.modules.update({"inro": inro, "inro.modeller": modeller, "inro.emme": emme,
+                        "inro.emme.desktop": desktop, "inro.emme.desktop.app": app})
+
+def LoadBridge():
+    InstallModellerStandIn()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import ModellerBridge
+    return ModellerBridge
+
+class BenchmarkTool(StandInTool):
+    count = StandInAttribute(int)
+    factor = StandInAttribute(float)
+    name = StandInAttribute(str)
+    enabled = StandInAttribute(bool)
+
+    def __call__(self, count, factor, name, enabled):
+        return count
+
+BenchmarkNamespace = "xtmf.benchmark.tool"
+StandInTools[BenchmarkNamespace] = BenchmarkTool
+BenchmarkParameterNames = ["count", "factor", "name", "enabled"]
+BenchmarkParameterValues = ["12", "3.5", "Toronto", "True"]
+
+def CreateBridge(bridgeModule, transport):
+    bridge = bridgeModule.XTMFBridge.__new__(bridgeModule.XTMFBridge)
+    bridge.InitializeState("XTMF")
+    bridge.AttachModeller(None, None)
+    bridge.Connect(transport)
+    return bridge
+
+def MakeTransports(bridgeModule):
+    """Make a connected pair of transports, one for the bridge and one for us to play XTMF"""
+    class LoopbackTransport(bridgeModule.SocketTransport):
+        def __init__(self, connectedSocket):
+            self.socket = connectedSocket
+    bridgeSide, xtmfSide = socket.socketpair()
+    return LoopbackTransport(bridgeSide), LoopbackTransport(xtmfSide)
+
+def MakeNullTransport(bridgeModule):
+    class NullTransport(bridgeModule.XTMFTransport):
+        def send(self, data):
+            pass
+
+        def recv_into(self, view):
+            return 0
+    return NullTransport()
+
+def Measure(operation, count, repeat):
+    """Time operation(count) repeat times, returning the best time for one operation in microseconds"""
+    best = None
+    for i in range(repeat):
+        start = Clock()
+        operation(count)
+        elapsed = Clock() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return {"operations": count, "microseconds": best / count * 1e6}
+
+def Percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def BenchmarkReadLEB(bridgeModule, count, repeat):
+    data = b"".join(bridgeModule.EncodeLEB(value) for value in [3, 200, 70000, 2 ** 28] * (count // 4))
+    def operation(n):
+        reader = bridgeModule.XTMFInputBuffer(io.BytesIO(data))
+        for i in range(n):
+            reader.ReadLEB()
+    return Measure(operation, (count // 4) * 4, repeat)
+
+def BenchmarkReadString(bridgeModule, count, repeat, length):
+    encoded = (u"x" * length).encode("utf-16-le")
+    data = (bridgeModule.EncodeLEB(len(encoded)) + encoded) * count
+    def operation(n):
+        reader = bridgeModule.XTMFInputBuffer(io.BytesIO(data))
+        for i in range(n):
+            reader.ReadString()
+    return Measure(operation, count, repeat)
+
+def BenchmarkSendString(bridgeModule, count, repeat):
+    bridge = CreateBridge(bridgeModule, MakeNullTransport(bridgeModule))
+    def operation(n):
+        for i in range(n):
+            bridge.SendReturnSuccess("A result from the tool")
+        bridge.Writer.Flush()
+    result = Measure(operation, count, repeat)
+    bridge.Writer.Close()
+    return result
+
+def BenchmarkBreakIntoParametersStrings(bridgeModule, count, repeat):
+    bridge = CreateBridge(bridgeModule, MakeNullTransport(bridgeModule))
+    parameterString = '12 3.5 "Toronto and the GTHA" True'
+    def operation(n):
+        for i in range(n):
+            bridge.BreakIntoParametersStrings(parameterString)
+    result = Measure(operation, count, repeat)
+    bridge.Writer.Close()
+    return result
+
+def BenchmarkConvertIntoTypes(bridgeModule, count, repeat):
+    bridge = CreateBridge(bridgeModule, MakeNullTransport(bridgeModule))
+    signature = bridge.GetToolSignature(BenchmarkTool())
+    def operation(n):
+        for i in range(n):
+            bridge.ConvertIntoTypes(list(BenchmarkParameterValues), signature.ParameterTypes, signature.ParameterNames)
+    result = Measure(operation, count, repeat)
+    bridge.Writer.Close()
+    return result
+
+def BenchmarkInvoke(bridgeModule, count, repeat):
+    bridge = CreateBridge(bridgeModule, MakeNullTransport(bridgeModule))
+    tool = BenchmarkTool()
+    signature = bridge.GetToolSignature(tool)
+    parameterList = bridge.ConvertIntoTypes(list(BenchmarkParameterValues), signature.ParameterTypes, signature.ParameterNames)
+    def operation(n):
+        for i in range(n):
+            signature.Invoke(tool, parameterList)
+    result = Measure(operation, count, repeat)
+    bridge.Writer.Close()
+    return result
+
+def BenchmarkExecEval(bridgeModule, count, repeat):
+    """How the bridge used to assign the parameters and call a tool, building source for exec and eval on every call"""
+    bridge = CreateBridge(bridgeModule, MakeNullTransport(bridgeModule))
+    tool = BenchmarkTool()
+    signature = bridge.GetToolSignature(tool)
+    parameterList = bridge.ConvertIntoTypes(list(BenchmarkParameterValues), signature.ParameterTypes, signature.ParameterNames)
+    def operation(n):
+        for i in range(n):
+            nameSpace = {"tool": tool, "parameterList": parameterList}
+            for name, typeName, value in zip(signature.ParameterNames, signature.ParameterTypes, parameterList):
+                if typeName == "string":
+                    toExecute = "tool." + name + "='" + str(value).replace("\\", "\\\\").replace("'", "\\'").replace("\"", "\\\"") + "'"
+                else:
+                    toExecute = "tool." + name + "=" + str(value)
+                exec(toExecute, nameSpace, {})
+            callString = "tool(" + str.join(",", ["parameterList[%i]" % p for p in range(len(parameterList))]) + ")"
+            eval(callString, nameSpace, None)
+    result = Measure(operation, count, repeat)
+    bridge.Writer.Close()
+    return result
+
+class SimulatedXTMF:
+    """Runs a bridge on another thread and talks to it the way XTMF does"""
+    def __init__(self, bridgeModule):
+        self.bridgeModule = bridgeModule
+        bridgeTransport, self.transport = MakeTransports(bridgeModule)
+        self.bridge = CreateBridge(bridgeModule, bridgeTransport)
+        self.reader = bridgeModule.XTMFInputBuffer(self.transport)
+        self.stdout = sys.stdout
+        self.thread = threading.Thread(target=self.bridge.Run, args=(False,))
+        self.thread.daemon = True
+        self.thread.start()
+        if self.reader.ReadInt() != self.bridge.SignalStart:
+            raise Exception("The bridge did not start!")
+        message = bytearray(self.bridge.EncodeSignal(self.bridge.SignalStartModuleBinaryParameters))
+        message += self.bridge.EncodeString(BenchmarkNamespace)
+        message += self.bridge.EncodeString(str(len(BenchmarkParameterNames)))
+        for name in BenchmarkParameterNames:
+            message += self.bridge.EncodeString(name)
+        for value in BenchmarkParameterValues:
+            message += self.bridge.EncodeString(value)
+        self.callMessage = bytes(message)
+
+    def ReadReply(self):
+        signal = self.reader.ReadInt()
+        if signal != self.bridge.SignalRunCompleteWithParameter:
+            raise Exception("The bridge replied with signal " + str(signal))
+        return self.reader.ReadString()
+
+    def Close(self):
+        self.transport.send(self.bridge.EncodeSignal(self.bridge.SignalTermination))
+        self.thread.join()
+        self.transport.close()
+        # The bridge sends anything printed to XTMF, and silences it when it exits
+        sys.stdout = self.stdout
+
+def BenchmarkExecuteModuleLatency(bridgeModule, count, repeat):
+    xtmf = SimulatedXTMF(bridgeModule)
+    try:
+        best = None
+        for r in range(repeat):
+            samples = []
+            for i in range(count):
+                start = Clock()
+                xtmf.transport.send(xtmf.callMessage)
+                xtmf.ReadReply()
+                samples.append((Clock() - start) * 1e6)
+            if best is None or Percentile(samples, 0.5) < Percentile(best, 0.5):
+                best = samples
+        return {"operations": count, "microseconds": Percentile(best, 0.5),
+                "p90_microseconds": Percentile(best, 0.9), "p99_microseconds": Percentile(best, 0.99)}
+    finally:
+        xtmf.Close()
+
+def BenchmarkExecuteModuleThroughput(bridgeModule, count, repeat):
+    xtmf = SimulatedXTMF(bridgeModule)
+    try:
+        def operation(n):
+            # Send from another thread so that neither side blocks on a full socket
+            sender = threading.Thread(target=lambda: xtmf.transport.send(xtmf.callMessage * n))
+            sender.start()
+            for i in range(n):
+                xtmf.ReadReply()
+            sender.join()
+        result = Measure(operation, count, repeat)
+        result["calls_per_second"] = 1e6 / result["microseconds"]
+        return result
+    finally:
+        xtmf.Close()
+
+def RunBenchmarks(scale, repeat):
+    bridgeModule = LoadBridge()
+    def n(count):
+        return max(1, int(count * scale))
+    results = OrderedDict([
+        ("ReadLEB", BenchmarkReadLEB(bridgeModule, n(200000), repeat)),
+        ("ReadString.Short", BenchmarkReadString(bridgeModule, n(100000), repeat, 16)),
+        ("ReadString.Long", BenchmarkReadString(bridgeModule, n(20000), repeat, 4096)),
+        ("SendString", BenchmarkSendString(bridgeModule, n(100000), repeat)),
+        ("BreakIntoParametersStrings", BenchmarkBreakIntoParametersStrings(bridgeModule, n(20000), repeat)),
+        ("ConvertIntoTypes", BenchmarkConvertIntoTypes(bridgeModule, n(100000), repeat)),
+        ("ToolSignature.Invoke", BenchmarkInvoke(bridgeModule, n(100000), repeat)),
+        ("ExecEval", BenchmarkExecEval(bridgeModule, n(20000), repeat)),
+        ("ExecuteModule.Latency", BenchmarkExecuteModuleLatency(bridgeModule, n(2000), repeat)),
+        ("ExecuteModule.Throughput", BenchmarkExecuteModuleThroughput(bridgeModule, n(5000), repeat)),
+    ])
+    return {"python": platform.python_version(), "platform": platform.platform(), "benchmarks": results}
+
+class EchoTool(StandInTool):
+    name = StandInAttribute(str)
+
+    def __call__(self, name):
+        return name
+
+class WaitTool(StandInTool):
+    seconds = StandInAttribute(float)
+
+    def __call__(self, seconds):
+        end = Clock() + seconds
+        while Clock() < end:
+            if self.XTMFBridge.CancellationToken.IsCancelled:
+                return "stopped early"
+            time.sleep(0.01)
+
+class TypedTool(StandInTool):
+    count = StandInAttribute(int)
+    factor = StandInAttribute(float)
+    name = StandInAttribute(str)
+    enabled = StandInAttribute(bool)
+
+    def __call__(self, count, factor, name, enabled):
+        return {"count": count, "values": [factor, enabled, None], "name": name}
+
+StandInTools["xtmf.check.echo"] = EchoTool
+StandInTools["xtmf.check.wait"] = WaitTool
+StandInTools["xtmf.check.typed"] = TypedTool
+
+class LoopbackXTMF:
+    """Runs a bridge on another thread and talks to it the way XTMF does, including the versions it has to negotiate"""
+    def __init__(self, bridgeModule):
+        self.bridgeModule = bridgeModule
+        bridgeTransport, self.transport = MakeTransports(bridgeModule)
+        # A bridge that stops answering fails the check instead of hanging it
+        self.transport.socket.settimeout(30)
+        self.bridge = CreateBridge(bridgeModule, bridgeTransport)
+        self.reader = bridgeModule.XTMFInputBuffer(self.transport)
+        self.version = 1
+        self.encoding = "utf-16-le"
+        self.stdout = sys.stdout
+        self.thread = threading.Thread(target=self.bridge.Run, args=(False,))
+        self.thread.daemon = True
+        self.thread.start()
+        Expect(self.reader.ReadInt() == self.bridge.SignalStart, "the bridge did not start")
+
+    def EncodeString(self, text):
+        encoded = text.encode(self.encoding)
+        return self.bridgeModule.EncodeLEB(len(encoded)) + encoded
+
+    def Send(self, signal, payload=b"", requestId=0):
+        if self.version >= 3:
+            self.transport.send(self.bridge._FrameHeader.pack(signal, requestId, len(payload)) + payload)
+        else:
+            self.transport.send(self.bridge.EncodeSignal(signal) + payload)
+
+    def Negotiate(self, version, encodings="utf-8,utf-16"):
+        self.Send(self.bridge.SignalNegotiateProtocol, self.bridge.EncodeInt(version) + self.EncodeString(encodings))
+        Expect(self.reader.ReadInt() == self.bridge.SignalProtocolAccepted, "the bridge did not accept the negotiation")
+        self.version = self.reader.ReadInt()
+        self.encoding = self.bridge.SupportedEncodings[self.reader.ReadString()]
+        self.reader.SetEncoding(self.encoding)
+        return self.version
+
+    def TypedCall(self, namespace, parameters, requestId=0):
+        payload = bytearray(self.EncodeString(namespace) + self.bridge.EncodeInt(len(parameters)))
+        for name, value in parameters:
+            payload += self.EncodeString(name)
+            for piece in self.bridgeModule.EncodeTypedValue(value):
+                payload += piece
+        self.Send(self.bridge.SignalStartModuleTypedParameters, bytes(payload), requestId)
+
+    def ReadFrame(self):
+        """Read a framed reply, returning the signal, request id and a reader over its payload"""
+        signal, requestId, payload = self.reader.ReadFrame()
+        payloadReader = self.bridgeModule.XTMFInputBuffer(io.BytesIO(payload))
+        payloadReader.SetEncoding(self.encoding)
+        return signal, requestId, payloadReader
+
+    def ReadTypedValue(self, reader):
+        tags = self.bridgeModule.TypeTag
+        tag = reader.ReadByte()
+        if tag == tags.Null:
+            return None
+        elif tag == tags.List:
+            return [self.ReadTypedValue(reader) for i in range(reader.ReadLEB())]
+        elif tag == tags.Dictionary:
+            ret = {}
+            for i in range(reader.ReadLEB()):
+                key = self.ReadTypedValue(reader)
+                ret[key] = self.ReadTypedValue(reader)
+            return ret
+        elif tag == tags.Int64:
+            return reader.ReadInt64()
+        elif tag == tags.Float64:
+            return reader.ReadDouble()
+        elif tag == tags.Bool:
+            return reader.ReadByte() != 0
+        elif tag == tags.String:
+            return reader.ReadUTF8String()
+        raise Exception("Unexpected type tag " + str(tag) + " in a typed result")
+
+    def Close(self):
+        try:
+            self.Send(self.bridge.SignalTermination)
+            self.thread.join(30)
+            self.transport.close()
+        finally:
+            # The bridge sends anything printed to XTMF, and silences it when it exits
+            sys.stdout = self.stdout
+
+def Expect(condition, problem):
+    if not condition:
+        raise Exception(problem)
+
+def CheckNegotiation(bridgeModule):
+    xtmf = LoopbackXTMF(bridgeModule)
+    try:
+        Expect(xtmf.Negotiate(2) == 2, "version 2 was not accepted")
+        Expect(xtmf.encoding == "utf-8", "UTF-8 was not chosen, got " + xtmf.encoding)
+        name = u"Montr\u00e9al \u2713"
+        payload = xtmf.EncodeString("xtmf.check.echo") + xtmf.EncodeString("1") + xtmf.EncodeString("name") + xtmf.EncodeString(name)
+        xtmf.Send(xtmf.bridge.SignalStartModuleBinaryParameters, payload)
+        Expect(xtmf.reader.ReadInt() == xtmf.bridge.SignalRunCompleteWithParameter, "the call did not complete")
+        Expect(xtmf.reader.ReadString() == name, "the string did not survive the trip in UTF-8")
+    finally:
+        xtmf.Close()
+
+def CheckFramedReplies(bridgeModule):
+    xtmf = LoopbackXTMF(bridgeModule)
+    try:
+        Expect(xtmf.Negotiate(3) == 3, "version 3 was not accepted")
+        xtmf.TypedCall("xtmf.check.wait", [("seconds", 0.3)], requestId=1)
+        xtmf.Send(xtmf.bridge.SignalCheckToolExists, xtmf.EncodeString("xtmf.check.echo"), requestId=2)
+        signal, requestId, payload = xtmf.ReadFrame()
+        Expect((signal, requestId) == (xtmf.bridge.SignalRunCompleteWithParameter, 2), "the check was not answered while the tool ran")
+        Expect(payload.ReadString() == "True", "the tool was not found")
+        signal, requestId, payload = xtmf.ReadFrame()
+        Expect((signal, requestId) == (xtmf.bridge.SignalRunComplete, 1), "the tool's reply was %s for request %s" % (signal, requestId))
+    finally:
+        xtmf.Close()
+
+def CheckCancellation(bridgeModule):
+    xtmf = LoopbackXTMF(bridgeModule)
+    bridge = xtmf.bridge
+    try:
+        xtmf.Negotiate(3)
+        xtmf.Send(bridge.SignalSetToolTimeout, bridge.EncodeInt(100) + bridge.EncodeInt(1000), requestId=1)
+        Expect(xtmf.ReadFrame()[:2] == (bridge.SignalRunComplete, 1), "the timeout was not set")
+        start = Clock()
+        xtmf.TypedCall("xtmf.check.wait", [("seconds", 10.0)], requestId=2)
+        signal, requestId, payload = xtmf.ReadFrame()
+        Expect((signal, requestId) == (bridge.SignalRuntimeError, 2) and "timeout" in payload.ReadString(), "the tool did not time out")
+        Expect(Clock() - start < 5.0, "the timeout took too long")
+        xtmf.Send(bridge.SignalSetToolTimeout, bridge.EncodeInt(0) + bridge.EncodeInt(1000), requestId=3)
+        Expect(xtmf.ReadFrame()[:2] == (bridge.SignalRunComplete, 3), "the timeout was not cleared")
+        xtmf.TypedCall("xtmf.check.wait", [("seconds", 10.0)], requestId=4)
+        time.sleep(0.1)
+        xtmf.Send(bridge.SignalCancelTool, bridge.EncodeInt(4), requestId=5)
+        replies = {}
+        for i in range(2):
+            signal, requestId, payload = xtmf.ReadFrame()
+            replies[requestId] = (signal, payload.ReadString())
+        Expect(replies.get(5) == (bridge.SignalRunCompleteWithParameter, "True"), "the cancel was not accepted")
+        Expect(replies.get(4, (None,))[0] == bridge.SignalRuntimeError and "XTMF cancelled it" in replies[4][1], "the tool was not cancelled")
+        Expect(Clock() - start < 5.0, "the cancel took too long")
+        # Cancelling something that is not running or waiting does nothing
+        xtmf.Send(bridge.SignalCancelTool, bridge.EncodeInt(4), requestId=6)
+        signal, requestId, payload = xtmf.ReadFrame()
+        Expect(payload.ReadString() == "False", "a finished request was cancelled")
+    finally:
+        xtmf.Close()
+
+def CheckTypedValues(bridgeModule):
+    xtmf = LoopbackXTMF(bridgeModule)
+    bridge = xtmf.bridge
+    try:
+        xtmf.Negotiate(3)
+        name = u"Z\u00fcrich"
+        xtmf.TypedCall("xtmf.check.typed", [("enabled", True), ("name", name), ("factor", 2.5), ("count", 7)], requestId=1)
+        data = bytearray()
+        while True:
+            signal, requestId, payload = xtmf.ReadFrame()
+            Expect(requestId == 1, "a reply was for request " + str(requestId))
+            if signal == bridge.SignalTypedResultChunk:
+                data += payload.ReadBytes(payload.ReadLEB())
+            else:
+                Expect(signal == bridge.SignalRunCompleteWithTypedResult, "the call replied with signal " + str(signal))
+                break
+        result = xtmf.ReadTypedValue(bridgeModule.XTMFInputBuffer(io.BytesIO(bytes(data))))
+        Expect(result == {"count": 7, "values": [2.5, True, None], "name": name}, "the typed result was " + repr(result))
+    finally:
+        xtmf.Close()
+
+def RunChecks():
+    """Run each check, printing if it passed, returning the number that failed"""
+    bridgeModule = LoadBridge()
+    checks = [("Negotiation", CheckNegotiation), ("FramedReplies", CheckFramedReplies),
+              ("Cancellation", CheckCancellation), ("TypedValues", CheckTypedValues)]
+    failures = 0
+    for name, check in checks:
+        try:
+            check(bridgeModule)
+            print("%-28s ok" % name)
+        except Exception as inst:
+            failures += 1
+            print("%-28s FAILED: %s" % (name, inst))
+    return failures
+
+# The Python types of the Modeller attributes, by the names the bridge gives them
+StubAttributeTypes = {"float": float, "int": int, "string": str, "bool": bool}
+
+def MakeStubTool(namespace, parameterNames, parameterTypes, durations):
+    """Make a tool with the same parameters as a recorded one, it takes no time unless it is given durations to sleep for"""
+    members = dict((name, StandInAttribute(StubAttributeTypes.get(typeName, str)))
+                   for name, typeName in zip(parameterNames, parameterTypes))
+    # The bridge reads the parameter names from the signature of __call__, so it has to be built from source
+    scope = {}
+    exec("def __call__(self%s):\n    return self.Run()\n" % "".join(", " + name for name in parameterNames), scope)
+    members["__call__"] = scope["__call__"]
+    members["Run"] = lambda self: time.sleep(durations.pop(0)) if durations else None
+    return type(str(namespace.replace(".", "_")), (StandInTool,), members)
+
+def ReplaySession(tracePath, timing):
+    bridgeModule = LoadBridge()
+    recorder = bridgeModule.SessionRecorder
+    inbound = bytearray()
+    recordedOutbound = 0
+    recordedToolSeconds = 0.0
+    recordedSeconds = 0.0
+    signatures = {}
+    durations = {}
+    calls = 0
+    for record in bridgeModule.ReadSessionRecords(tracePath):
+        # Calls are stamped with when they started, which is before the records written while they ran
+        recordedSeconds = max(recordedSeconds, record[1])
+        if record[0] == recorder.Inbound:
+            inbound += record[2]
+        elif record[0] == recorder.Outbound:
+            recordedOutbound += len(record[2])
+        else:
+            kind, when, duration, success, found, namespace, names, types = record
+            calls += 1
+            recordedToolSeconds += duration
+            # Tools that could not be found are left out so the replay fails the same way
+            if found:
+                signatures.setdefault(namespace, (names, types))
+                durations.setdefault(namespace, []).append(duration)
+    for namespace, (names, types) in signatures.items():
+        StandInTools[namespace] = MakeStubTool(namespace, names, types, durations[namespace] if timing == "recorded" else [])
+    bridgeTransport, xtmfTransport = MakeTransports(bridgeModule)
+    bridge = CreateBridge(bridgeModule, bridgeTransport)
+    stdout = sys.stdout
+    start = Clock()
+    runner = threading.Thread(target=bridge.Run, args=(True,))
+    runner.start()
+    def SendSession():
+        xtmfTransport.send(inbound)
+        # In case XTMF never told the bridge to exit, closing our side will
+        xtmfTransport.socket.shutdown(socket.SHUT_WR)
+    sender = threading.Thread(target=SendSession)
+    sender.start()
+    outbound = 0
+    buffer = bytearray(65536)
+    view = memoryview(buffer)
+    while True:
+        read = xtmfTransport.recv_into(view)
+        if not read:
+            break
+        outbound += read
+    elapsed = Clock() - start
+    sender.join()
+    runner.join()
+    xtmfTransport.close()
+    sys.stdout = stdout
+    return OrderedDict([
+        ("trace", tracePath),
+        ("timing", timing),
+        ("calls", calls),
+        ("recorded_seconds", recordedSeconds),
+        ("recorded_tool_seconds", recordedToolSeconds),
+        ("replay_seconds", elapsed),
+        ("microseconds_per_call", elapsed / calls * 1e6 if calls > 0 else None),
+        ("inbound_bytes", len(inbound)),
+        ("recorded_outbound_bytes", recordedOutbound),
+        ("replay_outbound_bytes", outbound),
+        ("phases", bridge.Performance.Report()),
+    ])
+
+def Compare(baseline, current, threshold):
+    """Print how each benchmark changed, returning the names of the ones that got slower by more than the threshold"""
+    regressions = []
+    print("%-28s %14s %14s %8s" % ("Benchmark", "Baseline (us)", "Current (us)", "Change"))
+    for name, result in current["benchmarks"].items():
+        before = baseline["benchmarks"].get(name)
+        if before is None:
+            print("%-28s %14s %14.3f" % (name, "-", result["microseconds"]))
+            continue
+        change = result["microseconds"] / before["microseconds"] - 1.0
+        flag = ""
+        if change > threshold:
+            regressions.append(name)
+            flag = "  slower"
+        print("%-28s %14.3f %14.3f %+7.1f%%%s" % (name, before["microseconds"], result["microseconds"], change * 100.0, flag))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the overhead of ModellerBridge without Emme.")
+    parser.add_argument("--output", help="write the results as JSON to this file instead of the console")
+    parser.add_argument("--compare", help="compare against the results saved from an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1, help="the fraction slower that counts as a regression")
+    parser.add_argument("--repeat", type=int, default=5, help="how many times to run each benchmark, the best is kept")
+    parser.add_argument("--scale", type=float, default=1.0, help="multiply the number of operations in each benchmark")
+    parser.add_argument("--replay", help="play a session recorded with XTMF_BRIDGE_CAPTURE back into a bridge with stub tools")
+    parser.add_argument("--replay-timing", choices=["none", "recorded"], default="none",
+                        help="if the stub tools return right away or take as long as the recorded calls did")
+    parser.add_argument("--check", action="store_true", help="check the negotiated protocol, cancellation and typed values instead of benchmarking")
+    args = parser.parse_args()
+    if args.check:
+        if RunChecks():
+            sys.exit(1)
+        return
+    if args.replay:
+        results = ReplaySession(args.replay, args.replay_timing)
+        if args.output:
+            with open(args.output, "w") as outputFile:
+                json.dump(results, outputFile, indent=2)
+        else:
+            print(json.dumps(results, indent=2))
+        return
+    results = RunBenchmarks(args.scale, args.repeat)
+    if args.output:
+        with open(args.output, "w") as outputFile:
+            json.dump(results, outputFile, indent=2)
+    elif not args.compare:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as baselineFile:
+            baseline = json.load(baselineFile)
+        if Compare(baseline, results, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()